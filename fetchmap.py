@@ -19,42 +19,158 @@
 # example usage:
 # fetchmap.py -112.23 34.85 -104.58 40.67 -P A3 -s esri-topo -S /data/maps/naturalearth/ne_10m_roads_north_america.shp -g ~/roadtrip/2017/Roadtrip-2017.gpx -o ~/roadtrip/2017/planned-route.jpg
 
+import time
+
+# start of the run, imported first to include the time of the other imports in --timings
+START_TIME = time.time()
+
 import argparse
+import bz2
+import email.utils
+import gzip
+import hashlib
+import http.client
 import io
+import json
 import math
+import random
+import struct
 import sys
 import os
 import os.path
 import subprocess
+import threading
 import urllib.parse
 import urllib.request
+import zlib
+import xml.etree.ElementTree as ElementTree
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from html.parser import HTMLParser
 from inspect import getframeinfo, currentframe
 from pathlib import Path
 
 import re
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+import sqlite3
+from PIL import Image, ImageDraw, ImageFont
+
+# optional modules, imported on first use by have_gdal(), have_fontconfig(), have_numpy() and
+# have_osmium(), as importing them takes a lot of the startup time
+ogr = None
+fontconfig = None
+numpy = None
+osmium = None
+HAVE_GDAL = None
+HAVE_FONTCONFIG = None
+HAVE_NUMPY = None
+HAVE_OSMIUM = None
+
+
+def have_gdal():
+    """
+    Import the GDAL bindings on first use
+    :return: True if available
+    """
+    global ogr, HAVE_GDAL
+    if HAVE_GDAL is None:
+        try:
+            from osgeo import ogr
+            HAVE_GDAL = True
+        except:
+            print("NOTE: GDAL bindings not available, won't render streets")
+            HAVE_GDAL = False
+    return HAVE_GDAL
+
+
+def have_fontconfig():
+    """
+    Import Python-fontconfig on first use
+    :return: True if available
+    """
+    global fontconfig, HAVE_FONTCONFIG
+    if HAVE_FONTCONFIG is None:
+        try:
+            import fontconfig
+            HAVE_FONTCONFIG = True
+        except:
+            HAVE_FONTCONFIG = False
+    return HAVE_FONTCONFIG
+
+
+def have_numpy():
+    """
+    Import NumPy on first use
+    :return: True if available
+    """
+    global numpy, HAVE_NUMPY
+    if HAVE_NUMPY is None:
+        try:
+            import numpy
+            HAVE_NUMPY = True
+        except:
+            HAVE_NUMPY = False
+    return HAVE_NUMPY
 
-try:
-    from osgeo import ogr
-    import json
 
-    HAVE_GDAL = True
-except:
-    print("NOTE: GDAL bindings not available, won't render streets")
-    HAVE_GDAL = False
+def have_osmium():
+    """
+    Import pyosmium on first use
+    :return: True if available
+    """
+    global osmium, HAVE_OSMIUM
+    if HAVE_OSMIUM is None:
+        try:
+            import osmium
+            HAVE_OSMIUM = True
+        except:
+            HAVE_OSMIUM = False
+    return HAVE_OSMIUM
 
-try:
-    import fontconfig
-    HAVE_FONTCONFIG = True
-except:
-    HAVE_FONTCONFIG = False
 
 DEFAULT_TILESERVER = "wikimedia"
 DEFAULT_SHAPEFILE = "/data/maps/naturalearth/ne_10m_roads_north_america.shp"
 
+# seconds from the start until the map is rendered, longer startups are reported by --timings
+STARTUP_BUDGET = 1.0
+# minimum number of points for which NumPy is used, it's not worth importing it for less
+NUMPY_MIN_POINTS = 1000
+
+# number of worker threads fetching tiles, the number of concurrent
+# connections to a single server is limited by --connections
+FETCH_WORKERS = 16
+# maximum number of tiles being fetched or waiting to be pasted, bounds the memory of decoded tiles
+FETCH_QUEUE = 2 * FETCH_WORKERS
+DEFAULT_HOST_CONNECTIONS = 4
+
+HTTP_TIMEOUT = 60
+HTTP_MAX_REDIRECTS = 5
+USER_AGENT = "fetchmap.py"
+
+# requests per second to a tile server, may be overridden by "ratelimit" in TileserverList
+DEFAULT_RATE_LIMIT = 10
+# retries of failed requests, with exponential backoff starting at RETRY_BACKOFF seconds
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_MAX_WAIT = 300
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+# responses telling that a tile doesn't exist, only those are remembered as missing
+MISSING_STATUS = [204, 404, 410]
+
 OVERPASS_URI = "http://overpass-api.de/api/interpreter"
-OVERPASS_QUERY = '(node["place"="city"]({bbox});node["place"="town"]({bbox}););out body;'
+OVERPASS_QUERY = '[timeout:{timeout}];(node["place"="city"]({bbox});node["place"="town"]({bbox}););out body;'
+# days until cached Overpass responses are queried again
+OVERPASS_TTL = 30
+OVERPASS_RATE_LIMIT = 1
+# zoom factor of the tiles used as the cells of the place store, the places of a cell are fetched together
+PLACE_CELL_ZOOM = 8
+# maximum width and height in cells of the area of one Overpass query, larger areas are split
+OVERPASS_BOX_CELLS = 4
+# seconds the server may spend on the query of one area, plenty for the towns of OVERPASS_BOX_CELLS²
+# cells, and less than HTTP_TIMEOUT so the server reports a timeout before the connection is given up
+OVERPASS_TIMEOUT = 50
+# number of concurrent Overpass queries, the public server allows two per client
+OVERPASS_WORKERS = 2
 
 PaperSizes = {
     "A0": [841, 1189],
@@ -67,6 +183,10 @@ PaperSizes = {
     "A7": [74, 105]
 }
 
+# optional keys:
+#   "cachelimit": maximum size of the cached tiles, e.g. "2G"
+#   "ttl": days until cached tiles are revalidated with the server (default: DEFAULT_TILE_TTL)
+#   "ratelimit": maximum number of requests per second (default: DEFAULT_RATE_LIMIT)
 TileserverList = {
     "natgeo": {
         "style": "natgeo",
@@ -194,8 +314,44 @@ Styles = {
 tileshandle = DEFAULT_TILESERVER
 tilesserver = TileserverList[tileshandle]
 tilesize = 256
+# height of the horizontal bands the map is rendered in, 0 renders the whole map at once
+DEFAULT_BAND_HEIGHT = 0
+# maximum distance in pixels of points removed when simplifying tracks and streets, 0 keeps all points
+DEFAULT_SIMPLIFY = 0
+# cell size in pixels of the index for the label collision detection
+LABEL_GRID_SIZE = 256
+# maximum size in pixels of the boxes covering tracks for the label placement
+LABEL_OBSTACLE_SIZE = 16
+# number of points of the pieces tracks are split into, only the pieces reaching into a band are drawn on it
+TRACK_PIECE_POINTS = 64
+# tiers of the road index as (lowest zoom factor, zoom factor of the bucket tiles), a tier is used
+# up to the lowest zoom factor of the next one
+ROAD_INDEX_TIERS = [(0, 3), (5, 4), (7, 6), (9, 7)]
+# maximum distance in pixels of points removed from the roads in the index, at the highest zoom factor of the tier
+ROAD_INDEX_TOLERANCE = 0.5
+# lowest zoom factor roads of a level are kept in the index for, levels not listed are kept for all
+ROAD_LEVEL_MINZOOM = {
+    "State": 5,
+    "Other": 7,
+}
 
 Cachedir = "~/.cache/fetchmap"
+DEFAULT_TILECACHE = "mbtiles"
+# size limit of the cache of a tile source, may be overridden by "cachelimit" in TileserverList
+DEFAULT_CACHE_LIMIT = None
+# days until cached tiles are revalidated, may be overridden by "ttl" in TileserverList
+DEFAULT_TILE_TTL = 30
+# hours until a tile the server reported as not existing is requested again
+DEFAULT_MISSING_TTL = 1
+# number of tile rows downloaded at once when seeding the cache
+SEED_ROWS = 16
+
+# per host semaphores limiting the number of concurrent downloads
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+# per host token buckets limiting the request rate
+rate_limiters = {}
 
 # filename and directory stuff
 
@@ -282,6 +438,27 @@ def deg2pixel(lat, lon, zoom):
     return deg2num(lat, lon, zoom, tilesize)
 
 
+def deg2pixels(lats, lons, zoom):
+    """
+    Calculate pixel coordinates for many coordinates at once, with NumPy if available. Both ways
+    give the same pixels as deg2pixel().
+    :param lats: sequence of latitudes
+    :param lons: sequence of longitudes
+    :param zoom: zoom factor
+    :return: tuple of lists with the x and y pixel coordinates
+    """
+    if len(lats) < NUMPY_MIN_POINTS or not have_numpy():
+        pixels = [deg2num(lat, lon, zoom, tilesize) for lat, lon in zip(lats, lons)]
+        return [p[0] for p in pixels], [p[1] for p in pixels]
+
+    # same operations in the same order as deg2num(), truncated like int()
+    lat_rad = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    n = tilesize * 2.0 ** zoom
+    xtile = numpy.trunc((numpy.asarray(lons, dtype=numpy.float64) + 180.0) / 360.0 * n)
+    ytile = numpy.trunc((1.0 - numpy.log(numpy.tan(lat_rad) + (1 / numpy.cos(lat_rad))) / math.pi) / 2.0 * n)
+    return xtile.astype(numpy.int64).tolist(), ytile.astype(numpy.int64).tolist()
+
+
 def num2deg(xtile, ytile, zoom):
     """
     Calculate North/West coordinates from tile
@@ -328,6 +505,47 @@ def get_bbox(x1, y1, x2, y2, zoom):
     lat2, lon2 = num2deg(x2 + 1, y2, zoom)
     return lat1, lon1, lat2, lon2
 
+
+def get_cell_range(x1, y1, x2, y2, zoom, cellzoom):
+    """
+    Calculate the range of the tiles of another zoom factor (cells) covering a range of tiles
+    :param x1: left x tile number
+    :param y1: south y tile number
+    :param x2: right x tile number
+    :param y2: north y tile number
+    :param zoom: zoom factor
+    :param cellzoom: zoom factor of the cells
+    :return: tuple of left, south, right and north cell numbers
+    """
+    if zoom >= cellzoom:
+        shift = zoom - cellzoom
+        return x1 >> shift, y1 >> shift, x2 >> shift, y2 >> shift
+    shift = cellzoom - zoom
+    return x1 << shift, ((y1 + 1) << shift) - 1, ((x2 + 1) << shift) - 1, y2 << shift
+
+
+def get_cells_inside(south, west, north, east, zoom):
+    """
+    Calculate the range of the tiles lying completely inside a bounding box
+    :param south: South latitude
+    :param west: West longitude
+    :param north: North latitude
+    :param east: East longitude
+    :param zoom: zoom factor
+    :return: tuple of left, south, right and north tile numbers, the range is empty if left > right or north > south
+    """
+    n = 2.0 ** zoom
+
+    def tile_y(lat):
+        lat_rad = math.radians(lat)
+        return (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n
+
+    x1 = math.ceil((west + 180.0) / 360.0 * n)
+    x2 = math.floor((east + 180.0) / 360.0 * n) - 1
+    y1 = math.floor(tile_y(max(south, -85.0511))) - 1
+    y2 = math.ceil(tile_y(min(north, 85.0511)))
+    return x1, y1, x2, y2
+
 def to_int(s):
     """
     Try to get an integer from an OSM kv attribute, to get
@@ -355,406 +573,2415 @@ def to_int(s):
     v = int(re.sub(r"[,.'\s]", "", v))
     return int(v)
 
-# Get data from cache or web service
 
-def fetch_tile(x, y, zoom):
+def to_bytes(s):
     """
-    Get a tile from the cache or tile server
-    :param x: x tile number
-    :param y: y tile number
-    :param zoom: zoom factor
-    :return: image
+    Get a size in bytes from a string like "500M" or "2G"
+    :param s: size with an optional K, M, G or T suffix (powers of 1024), or int
+    :return: int
     """
-    ydir = "{cdir}/{handle}/{zoom}/{x}".format(cdir=Cachedir, handle=tileshandle, zoom=zoom, x=x)
-    os.makedirs(ydir, exist_ok=True)
-    tilefile = "{}/{}.png".format(ydir, y)
-    url = tileserver.replace("${", "{").format(z=zoom, x=x, y=y)
-    # print("url={} cachefile={}".format(url, tilefile))
-    if os.path.exists(tilefile):
-        return Image.open(tilefile).convert("RGBA")
-
-    if args.dryrun:
-        return None
+    if isinstance(s, int):
+        return s
 
-    try:
-        with urllib.request.urlopen(url) as rfp:
-            tiledata = rfp.read()
-            with open(tilefile, "wb") as lfp:
-                lfp.write(tiledata)
-        return Image.open(io.BytesIO(tiledata)).convert("RGBA")
-    except:
-        print("Can't read tile {z}/{x}/{y}".format(z=zoom, x=x, y=y))
-        return None
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", s, re.IGNORECASE)
+    if not m:
+        raise ValueError("invalid size {}".format(s))
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " "))
 
 
-def fetch_labels(tile_west, tile_south, tile_east, tile_north, zoom):
+def format_size(size):
     """
-    Retreive a list of town names (labels) from cache or Overpass server for a given tile range
-    :param tile_west: West tile number
-    :param tile_south: South tile number
-    :param tile_east: East tile number
-    :param tile_north: North tile number
-    :param zoom: zoom factor
-    :return:
+    Format a size in bytes for humans
+    :param size: size in bytes
+    :return: string
     """
-    cachefile = "{cdir}/{z}-{w}-{s}-{e}-{n}.osm".format(cdir=Cachedir, z=zoom, w=tile_west, s=tile_south, e=tile_east,
-                                                        n=tile_north)
-    if os.path.exists(cachefile):
-        with open(cachefile, "r") as fp:
-            osmdata = fp.read()
-        return osmdata
-
-    lat1, lon1, lat2, lon2 = get_bbox(tile_west, tile_south, tile_east, tile_north, zoom)
-    bbox = "{y1},{x1},{y2},{x2}".format(y1=lat1, x1=lon1, y2=lat2, x2=lon2)
-    params = {
-        "data": OVERPASS_QUERY.format(bbox=bbox),
-    }
-
-    if args.dryrun:
-        return None
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
 
-    with urllib.request.urlopen(
-            urllib.request.Request(OVERPASS_URI, data=urllib.parse.urlencode(params).encode(), method="POST")) as rfp:
-        osmdata = rfp.read().decode("UTF-8")
-        with open(cachefile, "w") as lfp:
-            lfp.write(osmdata)
 
-    return osmdata
+# end of the phases of a run as (name, time), printed with --timings
+timings = []
 
 
-# XML parser helper(s)
-
-def latlon_from_attrs(attrs):
+def log_time(phase):
     """
-    Retrieve lat and lon values from XML tag attributes
-    :param attrs: list of attribute (key, val) tuples
-    :return: tuple of latitude and longitude values
+    Record the end of a phase of the run
+    :param phase: name of the phase
+    :return:
     """
-    lat = None
-    lon = None
-
-    for (k, v) in attrs:
-        if k == "lat":
-            lat = float(v)
-        if k == "lon":
-            lon = float(v)
-    return lat, lon
+    timings.append((phase, time.time()))
 
 
-# Font helper(s)
-
-def get_font_path(font_representation):
+def print_timings():
     """
-    Get the filesystem path to a font described by a fontconfig representation. See
-    https://www.freedesktop.org/software/fontconfig/fontconfig-user.html for specs
-
-    This function contains a workaround in case Python-fontconfig isn't available
-    :param font_representation: representation of a font, for example "Arial:style=Regular"
-    :return: path
+    Print the duration of the phases of the run, and a note if the startup took longer than STARTUP_BUDGET
+    :return:
     """
-    if HAVE_FONTCONFIG:
-        fcfont = fontconfig.query(family=font_representation, lang="en")
-        if len(fcfont) < 1:
-            return None
-        return fcfont[0].file
+    start = START_TIME
+    for phase, end in timings:
+        print("{:<10} {:8.3f} s".format(phase, end - start))
+        start = end
+    print("{:<10} {:8.3f} s".format("total", start - START_TIME))
 
-    res = subprocess.check_output(["fc-match", "-f", "%{file}", font_representation + ":stylelang=en"])
-    if res:
-        return str(res)
-    return None
+    if timings and timings[0][1] - START_TIME > STARTUP_BUDGET:
+        print("NOTE: startup took longer than {} s".format(STARTUP_BUDGET))
 
-def get_font(fontspec):
-    """
-    Gets a Pillow ImageFont from the font specification
-    :param fontspec: tuple of (font_representation, size), see get_font_path() for details
-    :return: ImageFont instance
-    """
-    fontfile = get_font_path(fontspec[0])
-    if not fontfile:
-        fontfile = get_font_path("Arial:style=Bold")
-        if not fontfile:
-            print("WARNING: neither {} nor Arial fonts are available".format(fontspec[0]))
-            return ImageFont.load_default()
+# HTTP connection handling
 
-    return ImageFont.truetype(fontfile, fontspec[1])
+HTTPResponse = namedtuple("HTTPResponse", ["status", "headers", "data"])
 
-class MapDraw:
+
+class ConnectionPool:
     """
-    Draw lines and labels on a map
+    Keep-alive HTTP(S) connections, pooled per server and shared by all downloads of a run
     """
 
-    def __init__(self, image, lat, lon, zoom, tilesize=256):
+    def __init__(self, timeout=HTTP_TIMEOUT):
         """
         Constructor
-        :param image: PIL image instance
-        :param lat: origin latitude
-        :param lon: origin longitude
-        :param zoom: zoo factor
-        :param tilesize: tile size
+        :param timeout: socket timeout in seconds
         """
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
 
-        self.set_image(image)
-        self.zoom = zoom
-        xorigin, yorigin = deg2num(lat, lon, zoom)
-        self.origin = (xorigin * tilesize, yorigin * tilesize)
-        self.cursor = (0, 0)
-        self.labels = []
-        self.style = Styles["default"]
-
-        self.wpticon = Image.open(Resourcedir + "/waypoint.png").convert("RGBA")
-        self.fonts = {}
-        self.set_fonts()
-
-    def set_style(self, styleid):
+    def connect(self, scheme, netloc):
         """
-        Set style of overlays
-        :param styleid: id of map style
-        :return:
+        Open a new connection to a server, honoring the proxy settings from the environment
+        :param scheme: "http" or "https"
+        :param netloc: host[:port] of the server
+        :return: tuple of http.client.HTTPConnection and True if requests need the absolute URL
         """
+        proxies = urllib.request.getproxies()
+        proxy = None
+        if scheme in proxies and not urllib.request.proxy_bypass(netloc):
+            proxy = urllib.parse.urlsplit(proxies[scheme])
+
+        if proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+            return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+        if proxy.scheme == "https":
+            conn = http.client.HTTPSConnection(proxy.netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(proxy.netloc, timeout=self.timeout)
 
-        if styleid in Styles:
-            st = Styles[styleid]
-            for attr in Styles[styleid].keys():
-                self.style[attr] = st[attr]
-            self.set_fonts()
-
-    def set_fonts(self):
-        for font in self.style["fonts"]:
-            self.fonts[font] = get_font(self.style["fonts"][font])
-
-    # noinspection PyAttributeOutsideInit,PyAttributeOutsideInit
-    def set_image(self, image):
-        self.image = image
-        self.canvas = ImageDraw.Draw(image)
-
-    def latlon_to_canvas(self, lat, lon):
-        """
-        Calculate pixel coordinates from lat/lon
-        :param lat: latitude
-        :param lon: longitude
-        :return:
-        """
-        xabs, yabs = deg2pixel(lat, lon, self.zoom)
-        return xabs - self.origin[0], yabs - self.origin[1]
+        if scheme == "https":
+            conn.set_tunnel(netloc)
+            return conn, False
+        return conn, True
 
-    def move(self, lat, lon):
+    def get_connection(self, scheme, netloc):
         """
-        Move cursor
-        :param lat: latitude
-        :param lon: longitude
-        :return:
+        Get an idle connection to a server from the pool, or open a new one
+        :param scheme: "http" or "https"
+        :param netloc: host[:port] of the server
+        :return: tuple of connection, True if requests need the absolute URL, and True if reused
         """
-        self.cursor = self.latlon_to_canvas(lat, lon)
-
-    def line(self, lat, lon, linetype="Track", linewidth=None, linecolor=None):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                self.reused += 1
+                return idle.pop() + (True,)
+            self.opened += 1
+        return self.connect(scheme, netloc) + (False,)
+
+    def put_connection(self, scheme, netloc, conn, absolute):
         """
-        Draw line from cursor to position
-        :param lat: latitude
-        :param lon: longitude
-        :param linetype: type of line for style
-        :param linewidth: width of line, overwrites style data
-        :param linecolor: color of line, overwrites style data
+        Return a connection to the pool for reuse
+        :param scheme: "http" or "https"
+        :param netloc: host[:port] of the server
+        :param conn: the connection
+        :param absolute: True if requests need the absolute URL
         :return:
         """
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append((conn, absolute))
 
-        if linewidth is None:
-            linewidth = canvas.style["linewidth"][linetype]
-        if linecolor is None:
-            linecolor = canvas.style["linecolor"][linetype]
-
-        pos = self.latlon_to_canvas(lat, lon)
-        self.canvas.line([self.cursor, pos], width=linewidth, fill=linecolor)
-        self.cursor = pos
-
-    def multiline(self, coords, linetype="Track"):
+    def request(self, url, data=None, headers=None, method=None):
         """
-        Draw multiple line segments
-        :param coords: list of coordinate pairs
-        :param linetype: type of line for style
-        :return:
+        Send a request and read the complete response, following redirects
+        :param url: URL to retrieve
+        :param data: request body (POST only)
+        :param headers: dict of additional request headers
+        :param method: request method, GET or POST depending on data if None
+        :return: HTTPResponse tuple of status code, response headers and body
         """
-        if len(coords) < 2: return
-        linewidth = canvas.style["linewidth"][linetype]
-        linecolor = canvas.style["linecolor"][linetype]
-        if "outlinecolor" in canvas.style:
-            outlinecolor = canvas.style["outlinecolor"][linetype]
-        else:
-            outlinecolor = "white"
+        if method is None:
+            method = "GET" if data is None else "POST"
 
-        if "outlinewidth" in canvas.style:
-            outlinewidth = linewidth + canvas.style["outlinewidth"][linetype] * 2
-        else:
-            outlinewidth = 0
+        for redirect in range(HTTP_MAX_REDIRECTS + 1):
+            response = self.request_once(url, data, headers, method)
+            location = response.headers.get("Location")
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
 
-        if outlinewidth > 0:
-            self.move(coords[0][1], coords[0][0])
-            for c in coords[1:]:
-                self.line(c[1], c[0], linewidth=outlinewidth, linecolor=outlinecolor)
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303:
+                method = "GET"
+                data = None
 
-        self.move(coords[0][1], coords[0][0])
-        for c in coords[1:]:
-            self.line(c[1], c[0], linewidth=linewidth, linecolor=linecolor)
+        return response
 
-    @staticmethod
-    def intersects(r1, r2):
+    def request_once(self, url, data, headers, method):
         """
-        Test if two rectangles intersect
-        :param r1: coordinates of the first rectangle, tupel of (x1, y1, x2, y2)
-        :param r2: coordinates of the second rectanble
-        :return: True if intersect
+        Send a single request, retrying once on a fresh connection if the server closed an idle one
+        :param url: URL to retrieve
+        :param data: request body
+        :param headers: dict of additional request headers
+        :param method: request method
+        :return: HTTPResponse tuple
         """
-        return max(r1[0], r2[0]) < min(r1[2], r2[2]) and max(r1[3], r2[3]) < min(r1[1], r2[1])
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        reqheaders = {"User-Agent": USER_AGENT}
+        if data is not None:
+            reqheaders["Content-Type"] = "application/x-www-form-urlencoded"
+        if headers:
+            reqheaders.update(headers)
+
+        while True:
+            conn, absolute, reused = self.get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, url if absolute else path, body=data, headers=reqheaders)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
 
-    def town_label(self, town):
+            if resp.will_close:
+                conn.close()
+            else:
+                self.put_connection(parts.scheme, parts.netloc, conn, absolute)
+            return HTTPResponse(resp.status, resp.headers, body)
+
+    def close(self):
         """
-        Draw a town label if it is either capital or does not intersect with a previously drawn
-        :param town: dict with town data, keys used currently: name, lat, lon, class
+        Close all idle connections
         :return:
         """
-        pos = self.latlon_to_canvas(town["lat"], town["lon"])
-        font = self.fonts[town["class"]]
-        msize = self.style["markersizes"][town["class"]]
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, absolute in idle:
+                    conn.close()
+            self.idle = {}
 
-        ts = self.canvas.textsize(town["name"], font=font)
-        textpos = [pos[0] - ts[0] / 2, pos[1] - ts[1] - msize - 4]
-        textbox = (textpos[0], textpos[1], textpos[0] + ts[0], textpos[1] - ts[1])
 
-        for l in self.labels:
-            if town["class"] == "capitals":
-                break
-            if self.intersects(textbox, l):
-                return
+connection_pool = ConnectionPool()
 
-        self.canvas.text(textpos, town["name"], font=font, fill="black")
-        self.labels.append(textbox)
 
-        markerbox = [pos[0] - msize, pos[1] - msize, pos[0] + msize, pos[1] + msize]
-        self.canvas.ellipse(markerbox, fill="black", outline="black")
-        self.labels.append((markerbox[0], markerbox[3], markerbox[2], markerbox[1]))
+class TokenBucket:
+    """
+    Token bucket rate limiter, allowing bursts of up to burst requests and rate requests per second on average
+    """
 
-        # self.labels.append(markerbox)
+    def __init__(self, rate, burst=None):
+        """
+        Constructor
+        :param rate: number of requests per second
+        :param burst: maximum number of requests at once, defaults to rate
+        """
+        self.rate = rate
+        self.capacity = burst if burst else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
 
-    def waypoint(self, lat, lon, text=None):
+    def pause(self, seconds):
         """
-        Draw a waypoint marker
-        :param lat: latitude
-        :param lon: longitude
-        :param text: label (unused)
+        Hold back all requests for some time, e.g. if the server asked for it with Retry-After
+        :param seconds: time to wait
         :return:
         """
-        x, y = self.latlon_to_canvas(lat, lon)
-        y -= self.wpticon.height
-        self.image.paste(self.wpticon, (x, y), self.wpticon)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
 
-        if text:
-            font = self.fonts["waypoints"]
-            textcolor = self.style["waypointcolor"]["text"]
-            bgcolor = self.style["waypointcolor"]["background"]
 
-            x += self.wpticon.width
-            ts = self.canvas.textsize(text, font=font)
-            bgpos = (x, y - ts[1] - 4)
-            textpos = (bgpos[0] + 4, bgpos[1])
+# Tile cache backends
 
-            bg = Image.new("RGBA", (ts[0] + 8, ts[1] + 8), color=bgcolor)
-            bg.putalpha(192)
-            self.image.paste(bg, bgpos, bg)
+# file extensions (as in the MBTiles metadata) and signatures of tile formats
+TileFormats = {
+    "png": [b"\x89PNG\r\n\x1a\n"],
+    "jpg": [b"\xff\xd8\xff"],
+    "webp": [b"RIFF"],
+    "gif": [b"GIF87a", b"GIF89a"],
+}
+
+
+def get_tile_format(data):
+    """
+    Determine the format of a tile from its data
+    :param data: tile data
+    :return: file extension, "png" if unknown
+    """
+    for tileformat, signatures in TileFormats.items():
+        for signature in signatures:
+            if data.startswith(signature):
+                return tileformat
+    return "png"
 
-            self.canvas.text(textpos, text, font=font, fill=textcolor)
 
+# cached tile data and the HTTP metadata needed to revalidate it, fetched is
+# the time of the download in seconds since the epoch (None if unknown)
+TileEntry = namedtuple("TileEntry", ["data", "fetched", "etag", "last_modified"])
 
-class GPXParser(HTMLParser):
+
+class DirectoryTileCache:
     """
-    Parse a GPX file and draw it's track and waypoints on the map
+    Tile cache storing each tile in a file {cachedir}/{handle}/{zoom}/{x}/{y}.{format}. Older versions
+    stored all tiles as {y}.png, whatever their format.
     """
 
-    def __init__(self, draw, features="any"):
+    def __init__(self, cachedir, handle, url=None, limit=None):
         """
         Constructor
-        :param draw: canvas
+        :param cachedir: cache directory
+        :param handle: id of the tile source
+        :param url: URL template of the tile server (unused)
+        :param limit: maximum size of the cache (unsupported)
         """
-        self.draw = draw
-        self.newtrk = True
-        self.render_track = features in ["trk", "any"]
-        self.render_waypoints = features in ["wpt", "any"]
-        self.waypoints = []
-        self.waypoint_translation = []
+        self.tiledir = os.path.join(cachedir, handle)
 
-        self.process_metadata = False
-        self.process_wpt = False
-        self.process_name = False
-        self.process_desc = False
-        self.wpt_name = None
-        self.wpt_desc = None
-        self.metadata_desc = None
-
-        super().__init__()
-
-    def handle_starttag(self, tag, attrs):
-        if self.render_track:
-            if tag == "trkseg":
-                self.newtrk = True
-            elif tag == "trkpt":
-                lat, lon = latlon_from_attrs(attrs)
-                if lat is None or lon is None:
-                    return
+    def get_filename(self, zoom, x, y, tileformat):
+        return os.path.join(self.tiledir, str(zoom), str(x), "{}.{}".format(y, tileformat))
 
-                if self.newtrk:
-                    self.draw.move(lat, lon)
-                    self.newtrk = False
-                else:
-                    self.draw.line(lat, lon, linetype="Track")
+    @staticmethod
+    def read(filename):
+        with open(filename, "rb") as fp:
+            return TileEntry(fp.read(), None, None, None)
 
-        if self.render_waypoints:
-            if tag == "wpt":
-                self.lat, self.lon = latlon_from_attrs(attrs)
-                self.process_wpt = True
-            elif tag == "metadata":
-                self.process_metadata = True
-
-            if self.process_wpt:
-                if tag == "name":
-                    self.wpt_name = ""
-                    self.process_name = True
-                elif tag == "desc":
-                    self.wpt_desc = ""
-                    self.process_desc = True
-            elif self.process_metadata:
-                if tag == "desc":
-                    self.metadata_desc = ""
-                    self.process_desc = True
+    def get(self, zoom, x, y):
+        """
+        Get a tile from the cache. There is no metadata in this cache, tiles never expire
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :return: TileEntry or None if not cached
+        """
+        for tileformat in TileFormats:
+            try:
+                return self.read(self.get_filename(zoom, x, y, tileformat))
+            except FileNotFoundError:
+                pass
+        return None
 
-    def handle_endtag(self, tag):
-        if self.render_waypoints:
-            if tag == "wpt" and self.lat is not None and self.lon is not None:
-                # print(self.wpt_name, self.wpt_desc)
-                self.waypoints.append((self.lat, self.lon, self.wpt_name))
-                self.waypoint_translation.append((self.wpt_name, self.wpt_desc))
-                self.wpt_name = None
-                self.wpt_desc = None
-            elif tag == "name":
-                self.process_name = False
-            elif tag == "desc":
-                if self.process_desc:
-                    self.process_desc = False
+    def get_range(self, zoom, swx, swy, nex, ney, data=True, count=True):
+        """
+        Get all cached tiles of a tile range
+        :param zoom: zoom factor
+        :param swx: x tile number of the South/West corner tile
+        :param swy: y tile number of the South/West corner tile
+        :param nex: x tile number of the North/East corner tile
+        :param ney: y tile number of the North/East corner tile
+        :param data: if False, only look up which tiles are cached, the data of the entries is None
+        :param count: unused, this cache keeps no statistics
+        :return: dict of TileEntry, indexed by (x, y) tuples
+        """
+        tiles = {}
+        for x in range(swx, nex + 1):
+            xdir = os.path.join(self.tiledir, str(zoom), str(x))
+            try:
+                names = {os.path.splitext(name)[0]: name for name in os.listdir(xdir)}
+            except FileNotFoundError:
+                continue
 
-    def handle_data(self, data):
-        if self.process_wpt:
-            if self.process_name:
-                self.wpt_name += data
-            if self.process_desc:
-                self.wpt_desc += data
-        elif self.process_metadata:
-            if self.process_desc:
-                self.metadata_desc += data
+            for y in range(ney, swy + 1):
+                name = names.get(str(y))
+                if name:
+                    tiles[(x, y)] = self.read(os.path.join(xdir, name)) if data else TileEntry(None, None, None, None)
+        return tiles
 
-    def draw_waypoints(self):
+    def put(self, zoom, x, y, data, etag=None, last_modified=None):
         """
-        Draw waypoint markers
+        Store a tile in the cache
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :param data: tile data
+        :param etag: ETag header of the response (unused)
+        :param last_modified: Last-Modified header of the response (unused)
         :return:
         """
-        if self.render_waypoints:
-            for wpt in self.waypoints:
+        tileformat = get_tile_format(data)
+        filename = self.get_filename(zoom, x, y, tileformat)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as fp:
+            fp.write(data)
+
+        # the server may have changed the format
+        for oldformat in TileFormats:
+            if oldformat != tileformat:
+                try:
+                    os.remove(self.get_filename(zoom, x, y, oldformat))
+                except FileNotFoundError:
+                    pass
+
+    def tiles(self):
+        """
+        Iterate over all cached tiles
+        :return: generator of (zoom, x, y, filename) tuples
+        """
+        for zdir in os.scandir(self.tiledir):
+            if not (zdir.is_dir() and zdir.name.isdigit()):
+                continue
+            for xdir in os.scandir(zdir.path):
+                if not (xdir.is_dir() and xdir.name.isdigit()):
+                    continue
+                for tilefile in os.scandir(xdir.path):
+                    y, ext = os.path.splitext(tilefile.name)
+                    if y.isdigit() and tilefile.is_file():
+                        yield int(zdir.name), int(xdir.name), int(y), tilefile.path
+
+    def refresh(self, zoom, x, y, etag=None, last_modified=None):
+        pass
+
+    def get_missing_range(self, zoom, swx, swy, nex, ney):
+        return {}
+
+    def put_missing(self, zoom, x, y, status, expires):
+        pass
+
+    def close(self):
+        pass
+
+
+class MBTilesCache:
+    """
+    Tile cache storing all tiles of a tile source in a single MBTiles file {cachedir}/{handle}.mbtiles,
+    see https://github.com/mapbox/mbtiles-spec for the format. Note that MBTiles count tile rows from
+    the South (TMS scheme).
+
+    Besides the MBTiles tables the file keeps the time of the last access of each tile for LRU
+    eviction, and per zoom level statistics, maintained by triggers, so the size of the cache is
+    known without scanning all tiles.
+    """
+
+    def __init__(self, cachedir, handle, url=None, limit=None):
+        """
+        Constructor
+        :param cachedir: cache directory
+        :param handle: id of the tile source
+        :param url: URL template of the tile server, used to guess the tile format for new files
+        :param limit: maximum size of the tile data in bytes, None for no limit
+        """
+        os.makedirs(cachedir, exist_ok=True)
+        self.filename = os.path.join(cachedir, handle + ".mbtiles")
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.accessed = set()
+        self.hits = {}
+        self.misses = {}
+
+        self.db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        # only effective for new files
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # fire the delete triggers for rows replaced by INSERT OR REPLACE
+        self.db.execute("PRAGMA recursive_triggers=ON")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                              tile_data BLOB, last_access INTEGER, fetched INTEGER,
+                                              etag TEXT, last_modified TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+        """)
+
+        tileformat = "jpg" if url and url.endswith(".jpg") else "png"
+        self.db.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+                            [("name", handle), ("format", tileformat), ("type", "baselayer")])
+        self.format = self.db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+        self.upgrade()
+
+    def upgrade(self):
+        """
+        Add the bookkeeping columns, tables and triggers to files written by older versions
+        :return:
+        """
+        with self.db:
+            self.db.execute("BEGIN")
+            columns = [c[1] for c in self.db.execute("PRAGMA table_info(tiles)")]
+            if "last_access" not in columns:
+                self.db.execute("ALTER TABLE tiles ADD COLUMN last_access INTEGER")
+                self.db.execute("UPDATE tiles SET last_access=?", (int(time.time()),))
+            if "fetched" not in columns:
+                self.db.execute("ALTER TABLE tiles ADD COLUMN fetched INTEGER")
+                self.db.execute("ALTER TABLE tiles ADD COLUMN etag TEXT")
+                self.db.execute("ALTER TABLE tiles ADD COLUMN last_modified TEXT")
+                self.db.execute("UPDATE tiles SET fetched=last_access")
+
+            if not self.db.execute("SELECT name FROM sqlite_master WHERE name='cache_stats'").fetchone():
+                self.db.execute("CREATE TABLE cache_stats (zoom_level INTEGER PRIMARY KEY, "
+                                "entries INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0, "
+                                "hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)")
+                self.db.execute("INSERT INTO cache_stats (zoom_level, entries, bytes) "
+                                "SELECT zoom_level, count(*), sum(length(tile_data)) FROM tiles GROUP BY zoom_level")
+
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS missing_tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                                          status INTEGER, expires INTEGER,
+                                                          PRIMARY KEY (zoom_level, tile_column, tile_row));
+                CREATE INDEX IF NOT EXISTS tile_access ON tiles (last_access);
+                CREATE TRIGGER IF NOT EXISTS tile_insert AFTER INSERT ON tiles BEGIN
+                    -- no conflict clause here, it would be overridden by INSERT OR REPLACE
+                    INSERT INTO cache_stats (zoom_level) SELECT NEW.zoom_level
+                        WHERE NOT EXISTS (SELECT 1 FROM cache_stats WHERE zoom_level=NEW.zoom_level);
+                    UPDATE cache_stats SET entries=entries + 1, bytes=bytes + length(NEW.tile_data)
+                        WHERE zoom_level=NEW.zoom_level;
+                END;
+                CREATE TRIGGER IF NOT EXISTS tile_delete AFTER DELETE ON tiles BEGIN
+                    UPDATE cache_stats SET entries=entries - 1, bytes=bytes - length(OLD.tile_data)
+                        WHERE zoom_level=OLD.zoom_level;
+                END;
+            """)
+
+    @staticmethod
+    def tms_row(zoom, y):
+        """
+        Convert between XYZ tile numbers and TMS tile rows, the conversion is symmetric
+        :param zoom: zoom factor
+        :param y: y tile number or tile row
+        :return: tile row or y tile number
+        """
+        return (1 << zoom) - 1 - y
+
+    def count(self, zoom, hits, misses):
+        """
+        Record cache hits and misses, needs to be called with the lock held
+        :param zoom: zoom factor
+        :param hits: number of hits
+        :param misses: number of misses
+        :return:
+        """
+        self.hits[zoom] = self.hits.get(zoom, 0) + hits
+        self.misses[zoom] = self.misses.get(zoom, 0) + misses
+
+    def get(self, zoom, x, y):
+        """
+        Get a tile from the cache
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :return: TileEntry or None if not cached
+        """
+        key = (zoom, x, self.tms_row(zoom, y))
+        with self.lock:
+            row = self.db.execute("SELECT tile_data, fetched, etag, last_modified FROM tiles "
+                                  "WHERE zoom_level=? AND tile_column=? AND tile_row=?", key).fetchone()
+            if row:
+                self.accessed.add(key)
+            self.count(zoom, 1 if row else 0, 0 if row else 1)
+        return TileEntry(*row) if row else None
+
+    def get_range(self, zoom, swx, swy, nex, ney, data=True, count=True):
+        """
+        Get all cached tiles of a tile range with a single query
+        :param zoom: zoom factor
+        :param swx: x tile number of the South/West corner tile
+        :param swy: y tile number of the South/West corner tile
+        :param nex: x tile number of the North/East corner tile
+        :param ney: y tile number of the North/East corner tile
+        :param data: if False, only look up which tiles are cached and their metadata, the data of the
+                     entries is None. The lookup doesn't count as access.
+        :param count: if False, don't count the hits and misses, for tiles read a second time
+        :return: dict of TileEntry, indexed by (x, y) tuples
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT tile_column, tile_row, {}, fetched, etag, last_modified FROM tiles "
+                                   "WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+                                   .format("tile_data" if data else "NULL"),
+                                   (zoom, swx, nex, self.tms_row(zoom, swy), self.tms_row(zoom, ney))).fetchall()
+            if data:
+                self.accessed.update((zoom, row[0], row[1]) for row in rows)
+            if data and count:
+                self.count(zoom, len(rows), (nex - swx + 1) * (swy - ney + 1) - len(rows))
+        return {(row[0], self.tms_row(zoom, row[1])): TileEntry(*row[2:]) for row in rows}
+
+    def put(self, zoom, x, y, data, etag=None, last_modified=None):
+        """
+        Store a tile in the cache
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :param data: tile data
+        :param etag: ETag header of the response
+        :param last_modified: Last-Modified header of the response
+        :return:
+        """
+        self.put_many([(zoom, x, y, data, time.time(), etag, last_modified)])
+
+    def put_many(self, tiles):
+        """
+        Store a number of tiles in the cache in a single transaction
+        :param tiles: iterable of (zoom, x, y, data, fetched, etag, last_modified) tuples
+        :return:
+        """
+        now = int(time.time())
+        rows = [(zoom, x, self.tms_row(zoom, y), data, now, int(fetched), etag, last_modified)
+                for (zoom, x, y, data, fetched, etag, last_modified) in tiles]
+        if not rows:
+            return
+
+        # the guess from the URL may be wrong, the format of the tiles is what counts
+        tileformat = get_tile_format(rows[-1][3])
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN")
+                if tileformat != self.format:
+                    self.format = tileformat
+                    self.db.execute("UPDATE metadata SET value=? WHERE name='format'", (tileformat,))
+                self.db.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, "
+                                    "last_access, fetched, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.executemany("DELETE FROM missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                    (row[:3] for row in rows))
+
+    def refresh(self, zoom, x, y, etag=None, last_modified=None):
+        """
+        Mark a cached tile as fresh after the server confirmed it didn't change
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :param etag: new ETag header, None to keep the current one
+        :param last_modified: new Last-Modified header, None to keep the current one
+        :return:
+        """
+        with self.lock:
+            self.db.execute("UPDATE tiles SET fetched=?, etag=coalesce(?, etag), "
+                            "last_modified=coalesce(?, last_modified) "
+                            "WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                            (int(time.time()), etag, last_modified, zoom, x, self.tms_row(zoom, y)))
+
+    def flush(self):
+        """
+        Write the access times and hit counters of this run to the file
+        :return:
+        """
+        now = int(time.time())
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.executemany("UPDATE tiles SET last_access=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                    ((now,) + key for key in self.accessed))
+                for zoom in set(self.hits) | set(self.misses):
+                    self.db.execute("INSERT OR IGNORE INTO cache_stats (zoom_level) VALUES (?)", (zoom,))
+                    self.db.execute("UPDATE cache_stats SET hits=hits + ?, misses=misses + ? WHERE zoom_level=?",
+                                    (self.hits.get(zoom, 0), self.misses.get(zoom, 0), zoom))
+            self.accessed = set()
+            self.hits = {}
+            self.misses = {}
+
+    def get_missing_range(self, zoom, swx, swy, nex, ney):
+        """
+        Get the tiles of a tile range the server recently reported as not existing
+        :param zoom: zoom factor
+        :param swx: x tile number of the South/West corner tile
+        :param swy: y tile number of the South/West corner tile
+        :param nex: x tile number of the North/East corner tile
+        :param ney: y tile number of the North/East corner tile
+        :return: dict of HTTP status codes, indexed by (x, y) tuples
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT tile_column, tile_row, status FROM missing_tiles WHERE zoom_level=? "
+                                   "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ? AND expires > ?",
+                                   (zoom, swx, nex, self.tms_row(zoom, swy), self.tms_row(zoom, ney),
+                                    int(time.time()))).fetchall()
+        return {(x, self.tms_row(zoom, row)): status for (x, row, status) in rows}
+
+    def put_missing(self, zoom, x, y, status, expires):
+        """
+        Remember a tile the server reported as not existing
+        :param zoom: zoom factor
+        :param x: x tile number
+        :param y: y tile number
+        :param status: HTTP status code, one of MISSING_STATUS
+        :param expires: time until the tile is skipped, in seconds since the epoch
+        :return:
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO missing_tiles (zoom_level, tile_column, tile_row, status, expires) "
+                            "VALUES (?, ?, ?, ?, ?)", (zoom, x, self.tms_row(zoom, y), status, int(expires)))
+
+    def prune_missing(self, expired_only=True):
+        """
+        Forget about missing tiles
+        :param expired_only: only remove expired entries
+        :return: number of removed entries
+        """
+        with self.lock:
+            if expired_only:
+                cur = self.db.execute("DELETE FROM missing_tiles WHERE expires <= ?", (int(time.time()),))
+            else:
+                cur = self.db.execute("DELETE FROM missing_tiles")
+        return cur.rowcount
+
+    def get_missing_count(self):
+        """
+        Get the number of tiles known to be missing
+        :return: int
+        """
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM missing_tiles WHERE expires > ?",
+                                   (int(time.time()),)).fetchone()[0]
+
+    def get_stats(self):
+        """
+        Get the statistics of the cache
+        :return: list of (zoom, entries, bytes, hits, misses) tuples
+        """
+        with self.lock:
+            return self.db.execute("SELECT zoom_level, entries, bytes, hits, misses FROM cache_stats "
+                                   "ORDER BY zoom_level").fetchall()
+
+    def get_size(self):
+        """
+        Get the size of the cached tile data
+        :return: size in bytes
+        """
+        with self.lock:
+            return self.db.execute("SELECT coalesce(sum(bytes), 0) FROM cache_stats").fetchone()[0]
+
+    def evict(self, limit):
+        """
+        Remove the least recently used tiles until the tile data fits into the size limit
+        :param limit: size limit in bytes
+        :return: tuple of number and size of the removed tiles
+        """
+        excess = self.get_size() - limit
+        if excess <= 0:
+            return 0, 0
+
+        removed = []
+        size = 0
+        with self.lock:
+            for rowid, length in self.db.execute("SELECT rowid, length(tile_data) FROM tiles ORDER BY last_access"):
+                removed.append((rowid,))
+                size += length
+                if size >= excess:
+                    break
+
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.executemany("DELETE FROM tiles WHERE rowid=?", removed)
+            self.db.execute("PRAGMA incremental_vacuum")
+        return len(removed), size
+
+    def prune(self, zooms=None, before=None):
+        """
+        Remove tiles by zoom level and/or time of last access
+        :param zooms: list of zoom factors, None for all
+        :param before: remove tiles not used since this time (seconds since the epoch), None for any time
+        :return: tuple of number and size of the removed tiles
+        """
+        where = []
+        params = []
+        if zooms:
+            where.append("zoom_level IN ({})".format(",".join("?" * len(zooms))))
+            params.extend(zooms)
+        if before is not None:
+            where.append("last_access < ?")
+            params.append(int(before))
+        condition = " WHERE " + " AND ".join(where) if where else ""
+
+        with self.lock:
+            with self.db:
+                self.db.execute("BEGIN")
+                count, size = self.db.execute("SELECT count(*), coalesce(sum(length(tile_data)), 0) FROM tiles" +
+                                              condition, params).fetchone()
+                self.db.execute("DELETE FROM tiles" + condition, params)
+        return count, size
+
+    def vacuum(self):
+        """
+        Shrink the file after removing tiles
+        :return:
+        """
+        with self.lock:
+            self.db.execute("VACUUM")
+
+    def close(self):
+        self.flush()
+        self.prune_missing()
+        if self.limit is not None:
+            count, size = self.evict(self.limit)
+            if count:
+                print("Tile cache: removed {} least recently used tiles ({})".format(count, format_size(size)))
+        with self.lock:
+            self.db.close()
+
+
+TileCaches = {
+    "directory": DirectoryTileCache,
+    "mbtiles": MBTilesCache,
+}
+
+tile_cache = None
+tile_ttl = DEFAULT_TILE_TTL
+road_index = None
+place_store = None
+
+# tiles which couldn't be retrieved: (zoom, x, y) -> (HTTP status, True if skipped as known missing)
+missing_tiles = {}
+
+
+def migrate_tile_cache(handle, delete=False, batchsize=1000):
+    """
+    Copy the tiles of a tile source from the directory cache into the MBTiles cache
+    :param handle: id of the tile source
+    :param delete: remove the tile files and directories after copying
+    :param batchsize: number of tiles stored per transaction
+    :return: number of tiles copied
+    """
+    src = DirectoryTileCache(Cachedir, handle)
+    dst = MBTilesCache(Cachedir, handle, TileserverList.get(handle, {}).get("url"))
+    count = 0
+    batch = []
+    files = []
+
+    def flush():
+        dst.put_many(batch)
+        if delete:
+            for f in files:
+                os.remove(f)
+        batch.clear()
+        files.clear()
+
+    for zoom, x, y, filename in src.tiles():
+        with open(filename, "rb") as fp:
+            # keep the modification time of the file as time of the download
+            batch.append((zoom, x, y, fp.read(), os.stat(fp.fileno()).st_mtime, None, None))
+        files.append(filename)
+        count += 1
+        if len(batch) >= batchsize:
+            flush()
+    flush()
+    dst.close()
+
+    if delete:
+        for dirpath, dirnames, filenames in os.walk(src.tiledir, topdown=False):
+            if not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    return count
+
+
+# Get data from cache or web service
+
+def get_host_slot(url):
+    """
+    Get the semaphore limiting the number of concurrent connections to the server of an URL
+    :param url: URL to be retrieved
+    :return: threading.BoundedSemaphore
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(args.connections)
+        return host_slots[host]
+
+
+def set_rate_limit(url, rate):
+    """
+    Set the maximum request rate for the server of an URL
+    :param url: URL on the server
+    :param rate: requests per second, None or 0 for no limit
+    :return:
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with host_slots_lock:
+        rate_limiters[host] = TokenBucket(rate) if rate else None
+
+
+def get_rate_limiter(url):
+    """
+    Get the rate limiter for the server of an URL
+    :param url: URL to be retrieved
+    :return: TokenBucket or None if the server has no rate limit
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    with host_slots_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = TokenBucket(args.rate) if args.rate else None
+        return rate_limiters[host]
+
+
+def get_retry_after(response):
+    """
+    Get the time the server asked us to wait before retrying
+    :param response: HTTPResponse
+    :return: seconds or None if the server didn't say
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    if retry_after.strip().isdigit():
+        return int(retry_after)
+
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_url(url, data=None, headers=None):
+    """
+    Send a request, observing the connection and rate limits of the server. Requests failing with
+    errors which are likely temporary are retried with jittered exponential backoff, or after the
+    time the server asked for with Retry-After.
+    :param url: URL to retrieve
+    :param data: request body (POST only)
+    :param headers: dict of additional request headers
+    :return: HTTPResponse of the last attempt
+    """
+    limiter = get_rate_limiter(url)
+
+    for attempt in range(args.retries + 1):
+        wait = None
+        try:
+            if limiter:
+                limiter.acquire()
+            with get_host_slot(url):
+                response = connection_pool.request(url, data=data, headers=headers)
+            if response.status not in RETRY_STATUS or attempt == args.retries:
+                return response
+
+            wait = get_retry_after(response)
+            if wait is not None and limiter:
+                limiter.pause(min(wait, RETRY_MAX_WAIT))
+        except (OSError, http.client.HTTPException):
+            if attempt == args.retries:
+                raise
+
+        if wait is None:
+            backoff = RETRY_BACKOFF * 2 ** attempt
+            wait = backoff / 2 + random.uniform(0, backoff / 2)
+        time.sleep(min(wait, RETRY_MAX_WAIT))
+
+
+def is_expired(fetched, ttl):
+    """
+    Check whether a cached download needs to be revalidated
+    :param fetched: time of the download in seconds since the epoch, None if unknown
+    :param ttl: time to live in days, None for infinite
+    :return: True if expired
+    """
+    if fetched is None or ttl is None:
+        return False
+    return time.time() - fetched > ttl * 86400
+
+
+def download_tile(x, y, zoom, entry=None):
+    """
+    Download a tile from the tile server and store it in the cache. If a cached tile is given,
+    it is revalidated with a conditional request, and its data returned if unchanged.
+    :param x: x tile number
+    :param y: y tile number
+    :param zoom: zoom factor
+    :param entry: expired TileEntry from the cache, or None
+    :return: tile data or None
+    """
+    if args.dryrun or args.offline:
+        return None
+
+    url = tileserver.replace("${", "{").format(z=zoom, x=x, y=y)
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+
+    # print("url={} headers={}".format(url, headers))
+    status = 0
+    try:
+        response = fetch_url(url, headers=headers)
+        status = response.status
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status == 304 and entry is not None:
+            tile_cache.refresh(zoom, x, y, etag, last_modified)
+            # entries looked up without data when seeding still need a result that isn't None
+            return entry.data if entry.data is not None else b""
+
+        if response.status != 200:
+            raise IOError("HTTP status {}".format(response.status))
+
+        tile_cache.put(zoom, x, y, response.data, etag, last_modified)
+        return response.data
+    except:
+        print("Can't read tile {z}/{x}/{y}".format(z=zoom, x=x, y=y))
+        if entry is None:
+            missing_tiles[(zoom, x, y)] = (status, False)
+            # network errors and overloaded servers are retried in the next run
+            if status in MISSING_STATUS:
+                tile_cache.put_missing(zoom, x, y, status, time.time() + args.missing_ttl * 3600)
+        return None
+
+
+def fetch_tile(x, y, zoom):
+    """
+    Get a tile from the cache or tile server
+    :param x: x tile number
+    :param y: y tile number
+    :param zoom: zoom factor
+    :return: image
+    """
+    return load_tile(x, y, zoom, tile_cache.get(zoom, x, y))
+
+
+def load_tile(x, y, zoom, entry):
+    """
+    Decode a tile, download it first if it isn't cached or revalidate it if it has expired
+    :param x: x tile number
+    :param y: y tile number
+    :param zoom: zoom factor
+    :param entry: TileEntry from the cache, None if not cached
+    :return: image
+    """
+    if entry is None:
+        tiledata = download_tile(x, y, zoom)
+    elif is_expired(entry.fetched, tile_ttl):
+        # use the stale tile if the server can't be reached
+        tiledata = download_tile(x, y, zoom, entry) or entry.data
+    else:
+        tiledata = entry.data
+
+    if tiledata is None:
+        return None
+
+    try:
+        return decode_tile(tiledata)
+    except:
+        print("Can't decode tile {z}/{x}/{y}".format(z=zoom, x=x, y=y))
+        return None
+
+
+def decode_tile(tiledata):
+    """
+    Decode a tile for pasting into the RGB base layer of the map. The alpha channel of transparent
+    tiles is dropped, as the final conversion of the map to RGB did before.
+    :param tiledata: tile data
+    :return: RGB image
+    """
+    tile = Image.open(io.BytesIO(tiledata))
+    if tile.mode == "RGB":
+        # opaque tiles (like JPEG) need no conversion, decode them here instead of when pasting
+        tile.load()
+        return tile
+    return tile.convert("RGB")
+
+
+def fetch_tiles(swx, swy, nex, ney, zoom, count=True):
+    """
+    Get the tiles of a tile range from the cache or tile server concurrently
+    :param swx: x tile number of the South/West corner tile
+    :param swy: y tile number of the South/West corner tile
+    :param nex: x tile number of the North/East corner tile
+    :param ney: y tile number of the North/East corner tile
+    :param zoom: zoom factor
+    :param count: if False, don't count cache hits and misses, for tiles read a second time
+    :return: generator of (x, y, image) tuples in the order the tiles arrive
+    """
+    cached = tile_cache.get_range(zoom, swx, swy, nex, ney, count=count)
+    known_missing = tile_cache.get_missing_range(zoom, swx, swy, nex, ney)
+    tiles = []
+
+    for y in range(ney, swy + 1):
+        for x in range(swx, nex + 1):
+            if (x, y) not in cached and (x, y) in known_missing:
+                missing_tiles[(zoom, x, y)] = (known_missing[(x, y)], True)
+            else:
+                tiles.append((x, y))
+
+    # tiles are submitted as earlier ones are consumed, so only FETCH_QUEUE decoded tiles are kept at a time
+    queue = iter(tiles)
+    futures = {}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        while True:
+            for x, y in queue:
+                futures[executor.submit(load_tile, x, y, zoom, cached.pop((x, y), None))] = (x, y)
+                if len(futures) >= FETCH_QUEUE:
+                    break
+            if not futures:
+                break
+
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                x, y = futures.pop(future)
+                yield x, y, future.result()
+
+
+def print_missing_tiles():
+    """
+    Print the list of tiles which couldn't be retrieved in this run
+    :return:
+    """
+    if not missing_tiles:
+        return
+
+    print("Missing tiles: {}".format(len(missing_tiles)))
+    for (zoom, x, y), (status, known) in sorted(missing_tiles.items()):
+        reason = "HTTP status {}".format(status) if status else "network error"
+        print("    {}/{}/{}: {}{}".format(zoom, x, y, reason, " (known, skipped)" if known else ""))
+
+
+def seed_tiles(swx, swy, nex, ney, zoom):
+    """
+    Download the missing and expired tiles of a tile range into the cache, without decoding them
+    :param swx: x tile number of the South/West corner tile
+    :param swy: y tile number of the South/West corner tile
+    :param nex: x tile number of the North/East corner tile
+    :param ney: y tile number of the North/East corner tile
+    :param zoom: zoom factor
+    :return: tuple of number of tiles already cached and not expired, downloaded and failed or known missing
+    """
+    cached = tile_cache.get_range(zoom, swx, swy, nex, ney, data=False)
+    known_missing = tile_cache.get_missing_range(zoom, swx, swy, nex, ney)
+    tiles = []
+    fresh = 0
+    skipped = 0
+
+    for y in range(ney, swy + 1):
+        for x in range(swx, nex + 1):
+            entry = cached.get((x, y))
+            if entry is not None and not is_expired(entry.fetched, tile_ttl):
+                fresh += 1
+                continue
+            if entry is None and (x, y) in known_missing:
+                missing_tiles[(zoom, x, y)] = (known_missing[(x, y)], True)
+                skipped += 1
+                continue
+            tiles.append((x, y, entry))
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = [executor.submit(download_tile, x, y, zoom, entry) for (x, y, entry) in tiles]
+        try:
+            for future in as_completed(futures):
+                if future.result() is None:
+                    failed += 1
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+
+    # expired tiles are counted as downloaded or failed, not as cached
+    return fresh, len(tiles) - failed, failed + skipped
+
+
+def seed_cache(args, rows=SEED_ROWS):
+    """
+    Download all tiles of a bounding box for a range of zoom factors, and the town names. Tiles already
+    cached are skipped, so an interrupted run can simply be started again.
+    :param args: args structure from get_seed_cmdline_args()
+    :param rows: number of tile rows downloaded in one go
+    :return:
+    """
+    try:
+        for zoom in args.zoom:
+            swx, swy, nex, ney, numx, numy = get_tilerange(args.south, args.west, args.north, args.east, zoom)
+            print("zoom {}: {}×{} tiles".format(zoom, numx, numy))
+            counts = [0, 0, 0]
+            for y in range(ney, swy + 1, rows):
+                result = seed_tiles(swx, min(y + rows - 1, swy), nex, y, zoom)
+                counts = [c + r for (c, r) in zip(counts, result)]
+                print("    row {}/{}: {} cached, {} downloaded, {} failed".format(min(y + rows, swy + 1) - ney, numy,
+                                                                                  *counts))
+
+            if not args.no_labels:
+                fetch_labels(swx, swy, nex, ney, zoom)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume")
+
+    print_missing_tiles()
+    tile_cache.close()
+    if place_store:
+        place_store.close()
+    connection_pool.close()
+
+
+class PlaceStore:
+    """
+    Local store of the towns and cities, in an SQLite file with an R*Tree index of their positions. The
+    world is divided into cells, the tiles of zoom factor PLACE_CELL_ZOOM, and the store keeps the time
+    the places of each cell were fetched, so maps sharing cells share the places.
+    """
+
+    def __init__(self, filename):
+        """
+        Constructor
+        :param filename: name of the SQLite file
+        """
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS places (id INTEGER PRIMARY KEY, name TEXT, class TEXT, population INTEGER,
+                                               lat REAL, lon REAL);
+            CREATE VIRTUAL TABLE IF NOT EXISTS places_index USING rtree(id, minlat, maxlat, minlon, maxlon);
+            CREATE TABLE IF NOT EXISTS place_cells (x INTEGER, y INTEGER, fetched INTEGER,
+                                                    PRIMARY KEY (x, y)) WITHOUT ROWID;
+        """)
+
+    def get_missing_cells(self, x1, y1, x2, y2, ttl=OVERPASS_TTL):
+        """
+        Get the cells of a range whose places were never fetched, or longer ago than the time to live
+        :param x1: left x cell number
+        :param y1: south y cell number
+        :param x2: right x cell number
+        :param y2: north y cell number
+        :param ttl: time to live in days
+        :return: list of (x, y) cell number tuples
+        """
+        fetched = set(self.db.execute("SELECT x, y FROM place_cells WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ? "
+                                      "AND fetched >= ?", (x1, x2, y2, y1, time.time() - ttl * 86400)))
+        return [(x, y) for y in range(y2, y1 + 1) for x in range(x1, x2 + 1) if (x, y) not in fetched]
+
+    def add_places(self, towns, bboxes, cells):
+        """
+        Replace the places of one or more areas with newly fetched ones
+        :param towns: list of town dicts like from get_town()
+        :param bboxes: list of tuples of South, West, North and East bounds of the areas, the places within are replaced
+        :param cells: list of (x, y) numbers of the cells covered by the areas, marked as fetched
+        :return:
+        """
+        with self.db:
+            self.db.execute("BEGIN")
+            for lat1, lon1, lat2, lon2 in bboxes:
+                old = [r[0] for r in self.db.execute("SELECT id FROM places_index WHERE minlat >= ? AND maxlat <= ? "
+                                                     "AND minlon >= ? AND maxlon <= ?", (lat1, lat2, lon1, lon2))]
+                self.db.executemany("DELETE FROM places WHERE id=?", [(i,) for i in old])
+                self.db.executemany("DELETE FROM places_index WHERE id=?", [(i,) for i in old])
+            self.db.executemany("INSERT OR REPLACE INTO places (id, name, class, population, lat, lon) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [(t["id"], t["name"], t["class"], t["population"], t["lat"], t["lon"]) for t in towns])
+            self.db.executemany("INSERT OR REPLACE INTO places_index (id, minlat, maxlat, minlon, maxlon) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                [(t["id"], t["lat"], t["lat"], t["lon"], t["lon"]) for t in towns])
+            fetched = int(time.time())
+            self.db.executemany("INSERT OR REPLACE INTO place_cells (x, y, fetched) VALUES (?, ?, ?)",
+                                [(x, y, fetched) for x, y in cells])
+
+    def get_places(self, lat1, lon1, lat2, lon2):
+        """
+        Get the places within a bounding box
+        :param lat1: South latitude
+        :param lon1: West longitude
+        :param lat2: North latitude
+        :param lon2: East longitude
+        :return: list of town dicts, ordered by OSM node id
+        """
+        # the R*Tree stores rounded coordinates, the exact ones are checked in the places table
+        rows = self.db.execute("SELECT p.id, p.name, p.class, p.population, p.lat, p.lon "
+                               "FROM places_index i JOIN places p ON p.id=i.id "
+                               "WHERE i.maxlat >= ? AND i.minlat <= ? AND i.maxlon >= ? AND i.minlon <= ? "
+                               "AND p.lat BETWEEN ? AND ? AND p.lon BETWEEN ? AND ? ORDER BY p.id",
+                               (lat1, lat2, lon1, lon2, lat1, lat2, lon1, lon2))
+        return [{"id": r[0], "name": r[1], "class": r[2], "population": r[3], "lat": r[4], "lon": r[5]} for r in rows]
+
+    def close(self):
+        """
+        Close the SQLite file
+        :return:
+        """
+        self.db.close()
+
+
+def get_place_store():
+    """
+    Open the place store on first use
+    :return: PlaceStore instance
+    """
+    global place_store
+    if place_store is None:
+        place_store = PlaceStore(os.path.join(Cachedir, "places.sqlite"))
+    return place_store
+
+
+def get_place_boxes(cells, size=OVERPASS_BOX_CELLS):
+    """
+    Group cells into the areas of separate Overpass queries, the cells of a square of a grid of
+    size×size cells go into one area
+    :param cells: list of (x, y) cell number tuples
+    :param size: width and height in cells of the squares
+    :return: list of (left, south, right, north) cell ranges covering the cells
+    """
+    squares = {}
+    for x, y in cells:
+        squares.setdefault((y // size, x // size), []).append((x, y))
+
+    return [(min(c[0] for c in square), max(c[1] for c in square), max(c[0] for c in square),
+             min(c[1] for c in square)) for key, square in sorted(squares.items())]
+
+
+def fetch_places(x1, y1, x2, y2):
+    """
+    Download the places of a range of cells from the Overpass server
+    :param x1: left x cell number
+    :param y1: south y cell number
+    :param x2: right x cell number
+    :param y2: north y cell number
+    :return: list of town dicts, None if the download failed
+    """
+    bbox = get_bbox(x1, y1, x2, y2, PLACE_CELL_ZOOM)
+    params = {
+        "data": OVERPASS_QUERY.format(bbox="{},{},{},{}".format(*bbox), timeout=OVERPASS_TIMEOUT),
+    }
+
+    try:
+        response = fetch_url(OVERPASS_URI, data=urllib.parse.urlencode(params).encode())
+    except (OSError, http.client.HTTPException) as e:
+        print("Can't read labels from Overpass server: {}".format(e))
+        return None
+
+    if response.status != 200:
+        print("Can't read labels from Overpass server: HTTP status {}".format(response.status))
+        return None
+
+    osm = OSMParser()
+    osm.feed(response.data.decode("UTF-8"))
+    osm.close()
+
+    # the server answers a query that ran out of time or memory with status 200, partial data and a remark
+    errors = [r for r in osm.get_remarks() if r.startswith("runtime error")]
+    if errors:
+        print("Can't read labels from Overpass server: {}".format(errors[0]))
+        return None
+    return osm.get_towns()
+
+
+def fetch_labels(tile_west, tile_south, tile_east, tile_north, zoom):
+    """
+    Retreive a list of town names (labels) for a given tile range from the place store, after downloading
+    the places of the cells missing in the store from the Overpass server
+    :param tile_west: West tile number
+    :param tile_south: South tile number
+    :param tile_east: East tile number
+    :param tile_north: North tile number
+    :param zoom: zoom factor
+    :return: list of town dicts
+    """
+    store = get_place_store()
+    if not (args.dryrun or args.offline):
+        x1, y1, x2, y2 = get_cell_range(tile_west, tile_south, tile_east, tile_north, zoom, PLACE_CELL_ZOOM)
+        missing = store.get_missing_cells(x1, y1, x2, y2)
+        # the Overpass API doesn't support conditional requests, so places are fetched again after
+        # OVERPASS_TTL days, if that fails the old ones are kept. Large areas are split into several
+        # queries, each stored when it arrives, so an interrupted download keeps what it got.
+        boxes = get_place_boxes(missing)
+        failed = 0
+        with ThreadPoolExecutor(max_workers=OVERPASS_WORKERS) as executor:
+            futures = {executor.submit(fetch_places, *box): box for box in boxes}
+            for future in as_completed(futures):
+                bx1, by1, bx2, by2 = futures[future]
+                towns = future.result()
+                if towns is None:
+                    failed += 1
+                    continue
+                # towns on the border of two areas are in both results, they are stored once by node id
+                store.add_places(towns, [get_bbox(bx1, by1, bx2, by2, PLACE_CELL_ZOOM)],
+                                 [(x, y) for y in range(by2, by1 + 1) for x in range(bx1, bx2 + 1)])
+        if failed:
+            print("Town names of {} of {} areas could not be downloaded".format(failed, len(boxes)))
+
+    return store.get_places(*get_bbox(tile_west, tile_south, tile_east, tile_north, zoom))
+
+
+def open_osm_file(filename):
+    """
+    Open an OSM XML file, compressed with gzip or bzip2 if the name ends with .gz or .bz2
+    :param filename: name of the file
+    :return: binary file object
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".bz2"):
+        return bz2.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def parse_osm_places(source):
+    """
+    Parse the towns and cities of an OSM XML file incrementally, processed elements are removed from the
+    document tree
+    :param source: file name or file object
+    :return: generator of ("bounds", south, west, north, east) tuples for the bounds of the extract and
+             ("town", town) tuples with the town dicts like from get_town()
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "start":
+            continue
+
+        if elem.tag == "node":
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            lat, lon = elem.get("lat"), elem.get("lon")
+            if tags.get("place") in ["city", "town"] and lat is not None and lon is not None:
+                town = get_town(int(elem.get("id")), float(lat), float(lon), tags)
+                if town:
+                    yield "town", town
+            root.clear()
+        elif elem.tag in ["way", "relation"]:
+            root.clear()
+        elif elem.tag == "bounds":
+            yield ("bounds", float(elem.get("minlat")), float(elem.get("minlon")), float(elem.get("maxlat")),
+                   float(elem.get("maxlon")))
+        elif elem.tag == "bound" and elem.get("box"):
+            # written by Osmosis as "south,west,north,east"
+            yield ("bounds",) + tuple(float(v) for v in elem.get("box").split(","))
+
+
+def parse_pbf_places(filename):
+    """
+    Read the towns and cities of an OSM PBF file with pyosmium
+    :param filename: name of the file
+    :return: list of tuples like from parse_osm_places()
+    """
+    items = []
+    reader = osmium.io.Reader(filename, osmium.osm.osm_entity_bits.NOTHING)
+    box = reader.header().box()
+    reader.close()
+    if box.valid():
+        items.append(("bounds", box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon))
+
+    class PlaceHandler(osmium.SimpleHandler):
+        def node(self, n):
+            if n.tags.get("place") in ["city", "town"] and n.location.valid():
+                town = get_town(n.id, n.location.lat, n.location.lon, {t.k: t.v for t in n.tags})
+                if town:
+                    items.append(("town", town))
+
+    PlaceHandler().apply_file(filename)
+    return items
+
+
+def import_places(filename):
+    """
+    Import the towns and cities of an OSM extract into the place store. The cells inside the bounds of
+    the extract are marked as fetched, so they are not queried from the Overpass server.
+    :param filename: name of an OSM XML file (optionally compressed with gzip or bzip2) or PBF file
+    :return: tuple of the number of towns and of cells marked as fetched
+    """
+    if filename.endswith(".pbf"):
+        items = parse_pbf_places(filename)
+    else:
+        with open_osm_file(filename) as fp:
+            items = list(parse_osm_places(fp))
+
+    towns = [item[1] for item in items if item[0] == "town"]
+    bboxes = [item[1:] for item in items if item[0] == "bounds"]
+    cells = set()
+    for bbox in bboxes:
+        x1, y1, x2, y2 = get_cells_inside(*bbox, PLACE_CELL_ZOOM)
+        cells.update((x, y) for y in range(y2, y1 + 1) for x in range(x1, x2 + 1))
+
+    get_place_store().add_places(towns, bboxes, sorted(cells))
+    return len(towns), len(cells)
+
+
+# XML parser helper(s)
+
+def latlon_from_attrs(attrs):
+    """
+    Retrieve lat and lon values from XML tag attributes
+    :param attrs: list of attribute (key, val) tuples
+    :return: tuple of latitude and longitude values
+    """
+    lat = None
+    lon = None
+
+    for (k, v) in attrs:
+        if k == "lat":
+            lat = float(v)
+        if k == "lon":
+            lon = float(v)
+    return lat, lon
+
+
+# Font helper(s)
+
+# fonts by (representation, size), paths of fonts by representation (None until read from the cache),
+# paths of substituted fonts by representation, text sizes by (font, text)
+fonts = {}
+font_paths = None
+font_substitutes = {}
+text_sizes = {}
+
+
+def get_font_path(font_representation):
+    """
+    Get the filesystem path to a font described by a fontconfig representation. See
+    https://www.freedesktop.org/software/fontconfig/fontconfig-user.html for specs
+
+    The paths are kept in Cachedir/fonts.json, fontconfig is only asked for new representations or
+    when the font file is gone. Fonts fontconfig substitutes for a family that isn't installed are
+    used but not kept, so the family is found once it is installed.
+
+    This function contains a workaround in case Python-fontconfig isn't available
+    :param font_representation: representation of a font, for example "Arial:style=Regular"
+    :return: path
+    """
+    global font_paths
+
+    cachefile = os.path.join(Cachedir, "fonts.json")
+    if font_paths is None:
+        font_paths = {}
+        try:
+            with open(cachefile, "r") as fp:
+                font_paths = json.load(fp)
+        except (OSError, ValueError):
+            pass
+
+    path = font_paths.get(font_representation)
+    if path and os.path.exists(path):
+        return path
+    if font_representation in font_substitutes:
+        return font_substitutes[font_representation]
+
+    path = None
+    exact = True
+    if have_fontconfig():
+        fcfont = fontconfig.query(family=font_representation, lang="en")
+        if len(fcfont) > 0:
+            path = fcfont[0].file
+    else:
+        # fc-match always finds a font, check whether it is of the requested family
+        res = subprocess.check_output(["fc-match", "-f", "%{family}\\n%{file}",
+                                       font_representation + ":stylelang=en"])
+        families, _, path = res.decode().partition("\n")
+        family = font_representation.split(":")[0].strip().lower()
+        exact = family in [f.strip().lower() for f in families.split(",")]
+        if path and not exact:
+            print("Font »{}« not found, using »{}« instead".format(font_representation, families))
+            font_substitutes[font_representation] = path
+
+    if path and exact:
+        font_paths[font_representation] = path
+        try:
+            os.makedirs(Cachedir, exist_ok=True)
+            with open(cachefile, "w") as fp:
+                json.dump(font_paths, fp, indent=1)
+        except OSError as e:
+            print("Cannot write font cache {}: {}".format(cachefile, e))
+    return path
+
+
+def get_font(fontspec):
+    """
+    Gets a Pillow ImageFont from the font specification, loaded once per process
+    :param fontspec: tuple of (font_representation, size), see get_font_path() for details
+    :return: ImageFont instance
+    """
+    fontspec = tuple(fontspec)
+    if fontspec in fonts:
+        return fonts[fontspec]
+
+    fontfile = get_font_path(fontspec[0])
+    if not fontfile:
+        fontfile = get_font_path("Arial:style=Bold")
+    if fontfile:
+        font = ImageFont.truetype(fontfile, fontspec[1])
+    else:
+        print("WARNING: neither {} nor Arial fonts are available".format(fontspec[0]))
+        font = ImageFont.load_default()
+
+    fonts[fontspec] = font
+    return font
+
+
+def get_text_size(text, font):
+    """
+    Get the size of a text, measured once per font and text
+    :param text: text
+    :param font: ImageFont instance
+    :return: tuple of width and height
+    """
+    key = (font, text)
+    if key not in text_sizes:
+        if hasattr(font, "getbbox"):
+            bbox = font.getbbox(text)
+            text_sizes[key] = (bbox[2], bbox[3])
+        else:
+            text_sizes[key] = font.getsize(text)
+    return text_sizes[key]
+
+
+def simplify_polyline(points, tolerance):
+    """
+    Simplify a line with the Douglas-Peucker algorithm, after dropping points on the same pixel as their predecessor
+    :param points: list of pixel coordinate tuples
+    :param tolerance: maximum distance in pixels of removed points from the simplified line
+    :return: list of pixel coordinate tuples
+    """
+    return [points[i] for i in get_simplified_indices(points, tolerance)]
+
+
+def get_simplified_indices(points, tolerance):
+    """
+    Get the points kept by simplify_polyline()
+    :param points: list of pixel coordinate tuples
+    :param tolerance: maximum distance in pixels of removed points from the simplified line
+    :return: list of indices of the kept points
+    """
+    indices = [i for i in range(len(points)) if i == 0 or points[i] != points[i - 1]]
+    if len(indices) < 3:
+        return indices
+    points = [points[i] for i in indices]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    maxdist = tolerance * tolerance
+    stack = [(0, len(points) - 1)]
+    use_numpy = len(points) >= NUMPY_MIN_POINTS and have_numpy()
+    if use_numpy:
+        xy = numpy.array(points, dtype=numpy.float64)
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        x1, y1 = points[first]
+        dx, dy = points[last][0] - x1, points[last][1] - y1
+        length = dx * dx + dy * dy
+        farthest, index = 0, 0
+
+        # squared distances to the segment from first to last point
+        if use_numpy:
+            x = xy[first + 1:last, 0] - x1
+            y = xy[first + 1:last, 1] - y1
+            if length:
+                t = numpy.clip((x * dx + y * dy) / length, 0, 1)
+                x, y = x - t * dx, y - t * dy
+            dist = x * x + y * y
+            i = int(dist.argmax())
+            farthest, index = dist[i], first + 1 + i
+        else:
+            for i in range(first + 1, last):
+                x, y = points[i][0] - x1, points[i][1] - y1
+                if length:
+                    t = min(max((x * dx + y * dy) / length, 0), 1)
+                    x, y = x - t * dx, y - t * dy
+                dist = x * x + y * y
+                if dist > farthest:
+                    farthest, index = dist, i
+
+        if farthest > maxdist:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [i for i, k in zip(indices, keep) if k]
+
+
+class GridIndex:
+    """
+    Spatial index of rectangles on a grid, to find intersecting rectangles without testing all of them
+    """
+
+    def __init__(self, cellsize=LABEL_GRID_SIZE):
+        """
+        Constructor
+        :param cellsize: size of the grid cells in pixels
+        """
+        self.cellsize = cellsize
+        self.cells = {}
+
+    def get_cells(self, box):
+        """
+        Get the grid cells a rectangle overlaps
+        :param box: rectangle, tuple of (x1, y1, x2, y2) with x1 <= x2 and y1 <= y2
+        :return: generator of cell coordinates
+        """
+        for cx in range(int(box[0] // self.cellsize), int(box[2] // self.cellsize) + 1):
+            for cy in range(int(box[1] // self.cellsize), int(box[3] // self.cellsize) + 1):
+                yield cx, cy
+
+    def insert(self, box):
+        """
+        Add a rectangle to the index
+        :param box: rectangle, tuple of (x1, y1, x2, y2)
+        :return:
+        """
+        for cell in self.get_cells(box):
+            self.cells.setdefault(cell, []).append(box)
+
+    def intersects(self, box):
+        """
+        Test if a rectangle intersects with any rectangle of the index, touching edges don't count
+        :param box: rectangle, tuple of (x1, y1, x2, y2)
+        :return: True if intersect
+        """
+        for cell in self.get_cells(box):
+            for r in self.cells.get(cell, ()):
+                if max(box[0], r[0]) < min(box[2], r[2]) and max(box[1], r[1]) < min(box[3], r[3]):
+                    return True
+        return False
+
+
+class BandIndex:
+    """
+    Index of items on the map by the pixel rows they cover, to draw only the items reaching into a band
+    of the map. Items beyond the top and bottom of the map are dropped.
+    """
+
+    def __init__(self, height, rowsize=LABEL_GRID_SIZE):
+        """
+        Constructor
+        :param height: height of the map in pixels
+        :param rowsize: height of the index rows in pixels
+        """
+        self.rowsize = rowsize
+        self.lastrow = height // rowsize + 1
+        self.rows = {}
+        self.count = 0
+
+    def get_rows(self, y1, y2):
+        """
+        Get the index rows a range of pixel rows overlaps, limited to the map and one row around it
+        :param y1: top pixel row
+        :param y2: bottom pixel row
+        :return: range of index rows
+        """
+        return range(max(int(y1 // self.rowsize), -1), min(int(y2 // self.rowsize), self.lastrow) + 1)
+
+    def insert(self, y1, y2, item):
+        """
+        Add an item to the index
+        :param y1: top pixel row of the item
+        :param y2: bottom pixel row of the item
+        :param item: item
+        :return:
+        """
+        for row in self.get_rows(y1, y2):
+            self.rows.setdefault(row, []).append((self.count, y1, y2, item))
+        self.count += 1
+
+    def get(self, y1, y2):
+        """
+        Get the items intersecting with a range of pixel rows
+        :param y1: top pixel row
+        :param y2: bottom pixel row
+        :return: list of items in the order they were added
+        """
+        found = {}
+        for row in self.get_rows(y1, y2):
+            for n, top, bottom, item in self.rows.get(row, ()):
+                if top <= y2 and bottom >= y1:
+                    found[n] = item
+        return [found[n] for n in sorted(found)]
+
+
+class MapDraw:
+    """
+    Draw lines and labels on a map
+    """
+
+    def __init__(self, image, lat, lon, zoom, tilesize=256, height=None):
+        """
+        Constructor
+        :param image: PIL image instance, the first band of the map
+        :param lat: origin latitude
+        :param lon: origin longitude
+        :param zoom: zoo factor
+        :param tilesize: tile size
+        :param height: height of the whole map in pixels, None if it is drawn in one band
+        """
+
+        self.top = 0
+        self.set_image(image)
+        self.height = height if height is not None else image.height
+        self.zoom = zoom
+        xorigin, yorigin = deg2num(lat, lon, zoom)
+        self.origin = (xorigin * tilesize, yorigin * tilesize)
+        self.cursor = (0, 0)
+        self.labels = GridIndex()
+        self.obstacles = GridIndex()
+        # town labels by the rows they cover, they are drawn on each band they reach into
+        self.placed_labels = BandIndex(self.height)
+        self.tolerance = DEFAULT_SIMPLIFY
+        self.vertices = [0, 0]
+        # keys of the lines counted in vertices, streets are drawn again on each band they reach into
+        self.counted = set()
+        self.style = Styles["default"]
+
+        self.wpticon = Image.open(Resourcedir + "/waypoint.png").convert("RGBA")
+        self.fonts = {}
+        self.set_fonts()
+
+    def set_style(self, styleid):
+        """
+        Set style of overlays
+        :param styleid: id of map style
+        :return:
+        """
+
+        if styleid in Styles:
+            st = Styles[styleid]
+            for attr in Styles[styleid].keys():
+                self.style[attr] = st[attr]
+            self.set_fonts()
+
+    def set_fonts(self):
+        for font in self.style["fonts"]:
+            self.fonts[font] = get_font(self.style["fonts"][font])
+
+    # noinspection PyAttributeOutsideInit,PyAttributeOutsideInit
+    def set_image(self, image):
+        self.image = image
+        self.canvas = ImageDraw.Draw(image)
+
+    def set_band(self, image, top):
+        """
+        Continue drawing on the next band of the map
+        :param image: PIL image instance of the band
+        :param top: y pixel coordinate of the band on the map
+        :return:
+        """
+        self.set_image(image)
+        self.top = top
+
+    def get_band_range(self, margin=0):
+        """
+        Get the pixel rows of the current band on the map
+        :param margin: number of rows added above and below, for lines and labels reaching into the band
+        :return: tuple of the top and bottom pixel row
+        """
+        return self.top - margin, self.top + self.image.height - 1 + margin
+
+    def latlon_to_map(self, lat, lon):
+        """
+        Calculate pixel coordinates on the whole map from lat/lon
+        :param lat: latitude
+        :param lon: longitude
+        :return:
+        """
+        xabs, yabs = deg2pixel(lat, lon, self.zoom)
+        return xabs - self.origin[0], yabs - self.origin[1]
+
+    def latlon_to_canvas(self, lat, lon):
+        """
+        Calculate pixel coordinates on the current band from lat/lon
+        :param lat: latitude
+        :param lon: longitude
+        :return:
+        """
+        x, y = self.latlon_to_map(lat, lon)
+        return x, y - self.top
+
+    def latlons_to_map(self, lats, lons):
+        """
+        Calculate pixel coordinates on the whole map for many coordinates at once
+        :param lats: sequence of latitudes
+        :param lons: sequence of longitudes
+        :return: list of pixel coordinate tuples
+        """
+        xs, ys = deg2pixels(lats, lons, self.zoom)
+        return [(x - self.origin[0], y - self.origin[1]) for x, y in zip(xs, ys)]
+
+    def latlons_to_canvas(self, lats, lons):
+        """
+        Calculate pixel coordinates on the current band for many coordinates at once
+        :param lats: sequence of latitudes
+        :param lons: sequence of longitudes
+        :return: list of pixel coordinate tuples
+        """
+        xs, ys = deg2pixels(lats, lons, self.zoom)
+        xorigin, yorigin = self.origin[0], self.origin[1] + self.top
+        return [(x - xorigin, y - yorigin) for x, y in zip(xs, ys)]
+
+    def move(self, lat, lon):
+        """
+        Move cursor
+        :param lat: latitude
+        :param lon: longitude
+        :return:
+        """
+        self.cursor = self.latlon_to_canvas(lat, lon)
+
+    def line(self, lat, lon, linetype="Track", linewidth=None, linecolor=None):
+        """
+        Draw line from cursor to position
+        :param lat: latitude
+        :param lon: longitude
+        :param linetype: type of line for style
+        :param linewidth: width of line, overwrites style data
+        :param linecolor: color of line, overwrites style data
+        :return:
+        """
+
+        if linewidth is None:
+            linewidth = self.style["linewidth"][linetype]
+        if linecolor is None:
+            linecolor = self.style["linecolor"][linetype]
+
+        pos = self.latlon_to_canvas(lat, lon)
+        self.canvas.line([self.cursor, pos], width=linewidth, fill=linecolor)
+        self.cursor = pos
+
+    def polyline(self, points, linewidth, linecolor):
+        """
+        Draw lines through a list of points in one go, with round joints between the segments
+        :param points: list of pixel coordinate tuples on the current band
+        :param linewidth: width of line
+        :param linecolor: color of line
+        :return:
+        """
+        if len(points) < 2:
+            return
+
+        # repeated pixels don't change the line, e.g. track points recorded while standing still
+        points = [points[0]] + [p for prev, p in zip(points, points[1:]) if p != prev]
+        if len(points) == 1:
+            # still drawn as a dot, like ImageDraw does with a line of length 0
+            points.append(points[0])
+
+        self.canvas.line(points, width=linewidth, fill=linecolor)
+
+        # fill the gaps at the corners of wide lines, a lot faster than joint="curve" of ImageDraw.
+        # The integer bounding box covers the same pixels as the circle of diameter linewidth - 1 around
+        # the point, but unlike fractional coordinates it is rounded the same way above the top of a band.
+        if linewidth > 2:
+            r1, r2 = linewidth // 2, (linewidth - 1) // 2
+            for (xa, ya), (x, y), (xb, yb) in zip(points, points[1:], points[2:]):
+                # no gap where the line goes straight on
+                if (x - xa) * (yb - y) == (y - ya) * (xb - x) and (x - xa) * (xb - x) + (y - ya) * (yb - y) > 0:
+                    continue
+                self.canvas.ellipse([x - r1, y - r1, x + r2, y + r2], fill=linecolor)
+
+    def simplify(self, points, key=None):
+        """
+        Simplify a line if a tolerance is set, and count the points before and after
+        :param points: list of pixel coordinate tuples
+        :param key: key of a line simplified again for each band, only its first time is counted, None to count always
+        :return: list of pixel coordinate tuples
+        """
+        count = key is None or key not in self.counted
+        if count and key is not None:
+            self.counted.add(key)
+        if count:
+            self.vertices[0] += len(points)
+        if self.tolerance > 0:
+            points = simplify_polyline(points, self.tolerance)
+        if count:
+            self.vertices[1] += len(points)
+        return points
+
+    def multiline(self, lats, lons, linetype="Track", key=None):
+        """
+        Draw multiple line segments
+        :param lats: sequence of latitudes
+        :param lons: sequence of longitudes
+        :param linetype: type of line for style
+        :param key: key of the line for counting its points only once, see simplify()
+        :return:
+        """
+        if len(lats) < 2: return
+        linewidth = self.style["linewidth"][linetype]
+        linecolor = self.style["linecolor"][linetype]
+        if "outlinecolor" in self.style:
+            outlinecolor = self.style["outlinecolor"][linetype]
+        else:
+            outlinecolor = "white"
+
+        if "outlinewidth" in self.style:
+            outlinewidth = linewidth + self.style["outlinewidth"][linetype] * 2
+        else:
+            outlinewidth = 0
+
+        points = self.simplify(self.latlons_to_canvas(lats, lons), key)
+        if outlinewidth > 0:
+            self.polyline(points, outlinewidth, outlinecolor)
+        self.polyline(points, linewidth, linecolor)
+
+    def add_obstacle(self, box):
+        """
+        Keep town labels off an area of the map
+        :param box: rectangle on the map, tuple of (x1, y1, x2, y2)
+        :return:
+        """
+        self.obstacles.insert(box)
+
+    def add_line_obstacle(self, points, linewidth):
+        """
+        Keep town labels off a line, covered by small boxes along the line
+        :param points: list of pixel coordinate tuples on the map
+        :param linewidth: width of line
+        :return:
+        """
+        margin = linewidth / 2
+        box = None
+        for (xa, ya), (xb, yb) in zip(points, points[1:]):
+            # split long segments, one box around them would cover a large area
+            steps = max(1, math.ceil(max(abs(xb - xa), abs(yb - ya)) / LABEL_OBSTACLE_SIZE))
+            for i in range(steps):
+                x1, y1 = xa + (xb - xa) * i / steps, ya + (yb - ya) * i / steps
+                x2, y2 = xa + (xb - xa) * (i + 1) / steps, ya + (yb - ya) * (i + 1) / steps
+                piece = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+                if box:
+                    joined = (min(box[0], piece[0]), min(box[1], piece[1]),
+                              max(box[2], piece[2]), max(box[3], piece[3]))
+                    if joined[2] - joined[0] <= LABEL_OBSTACLE_SIZE and joined[3] - joined[1] <= LABEL_OBSTACLE_SIZE:
+                        box = joined
+                        continue
+                    self.obstacles.insert((box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin))
+                box = piece
+
+        if box:
+            self.obstacles.insert((box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin))
+
+    @staticmethod
+    def get_label_positions(pos, size, msize):
+        """
+        Get the candidate positions of a town name around its marker, in order of preference:
+        N, NE, E, SE, S, SW, W, NW
+        :param pos: pixel coordinates of the town
+        :param size: size of the text
+        :param msize: size of the marker
+        :return: list of positions of the top left corner of the text
+        """
+        x, y = pos
+        w, h = size
+        d = msize + 4
+        c = msize + 2
+        return [
+            (x - w / 2, y - d - h),
+            (x + c, y - c - h),
+            (x + d, y - h // 2),
+            (x + c, y + c),
+            (x - w / 2, y + d),
+            (x - c - w, y + c),
+            (x - d - w, y - h // 2),
+            (x - c - w, y - c - h),
+        ]
+
+    def town_label(self, town):
+        """
+        Place a town label at the first position around the marker that neither intersects with a previously
+        placed label nor with a GPX track or waypoint. Capitals are placed above the marker if there is no free
+        position, other towns are dropped. The labels are drawn on each band by draw_labels().
+        :param town: dict with town data, keys used currently: name, lat, lon, class
+        :return:
+        """
+        pos = self.latlon_to_map(town["lat"], town["lon"])
+        font = self.fonts[town["class"]]
+        msize = self.style["markersizes"][town["class"]]
+
+        capital = town["class"] == "capitals"
+
+        # test the marker first, measuring the text takes much longer
+        markerbox = (pos[0] - msize, pos[1] - msize, pos[0] + msize, pos[1] + msize)
+        if not capital and self.labels.intersects(markerbox):
+            return
+
+        ts = get_text_size(town["name"], font)
+        positions = self.get_label_positions(pos, ts, msize)
+        for textpos in positions:
+            textbox = (textpos[0], textpos[1], textpos[0] + ts[0], textpos[1] + ts[1])
+            if not self.labels.intersects(textbox) and not self.obstacles.intersects(textbox):
+                break
+        else:
+            if not capital:
+                return
+            textpos = positions[0]
+            textbox = (textpos[0], textpos[1], textpos[0] + ts[0], textpos[1] + ts[1])
+
+        self.labels.insert(textbox)
+        self.labels.insert(markerbox)
+        self.placed_labels.insert(min(textbox[1], markerbox[1]), max(textbox[3], markerbox[3]),
+                                  (textpos, town["name"], font, markerbox))
+
+    def draw_labels(self):
+        """
+        Draw the placed town labels reaching into the current band
+        :return:
+        """
+        top, bottom = self.get_band_range(1)
+        for textpos, name, font, markerbox in self.placed_labels.get(top, bottom):
+            self.canvas.text((textpos[0], textpos[1] - self.top), name, font=font, fill="black")
+            self.canvas.ellipse([markerbox[0], markerbox[1] - self.top, markerbox[2], markerbox[3] - self.top],
+                                fill="black", outline="black")
+
+    def get_waypoint_boxes(self, lat, lon, text=None):
+        """
+        Get the rectangles covered by a waypoint marker and its label
+        :param lat: latitude
+        :param lon: longitude
+        :param text: label
+        :return: list of rectangles on the map, tuples of (x1, y1, x2, y2)
+        """
+        x, y = self.latlon_to_map(lat, lon)
+        y -= self.wpticon.height
+        boxes = [(x, y, x + self.wpticon.width, y + self.wpticon.height)]
+
+        if text:
+            x += self.wpticon.width
+            ts = get_text_size(text, self.fonts["waypoints"])
+            boxes.append((x, y - ts[1] - 4, x + ts[0] + 8, y + 4))
+        return boxes
+
+    def waypoint(self, lat, lon, text=None):
+        """
+        Draw a waypoint marker
+        :param lat: latitude
+        :param lon: longitude
+        :param text: label (unused)
+        :return:
+        """
+        x, y = self.latlon_to_canvas(lat, lon)
+        y -= self.wpticon.height
+        self.image.paste(self.wpticon, (x, y), self.wpticon)
+
+        if text:
+            font = self.fonts["waypoints"]
+            textcolor = self.style["waypointcolor"]["text"]
+            bgcolor = self.style["waypointcolor"]["background"]
+
+            x += self.wpticon.width
+            ts = get_text_size(text, font)
+            bgpos = (x, y - ts[1] - 4)
+            textpos = (bgpos[0] + 4, bgpos[1])
+
+            bg = Image.new("RGBA", (ts[0] + 8, ts[1] + 8), color=bgcolor)
+            bg.putalpha(192)
+            self.image.paste(bg, bgpos, bg)
+
+            self.canvas.text(textpos, text, font=font, fill=textcolor)
+
+
+def parse_gpx(source):
+    """
+    Parse a GPX file incrementally, processed elements are removed from the document tree
+    :param source: file name or file object
+    :return: generator of ("trkseg", lats, lons), ("wpt", lat, lon, name, desc) and ("desc", text)
+             tuples for the track segments, waypoints and the description in the metadata
+    """
+    # tags and elements from the root to the current element
+    path = []
+    lats, lons = None, None
+
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        # strip the namespace
+        tag = elem.tag.rsplit("}", 1)[-1]
+
+        if event == "start":
+            path.append((tag, elem))
+            if tag == "trkseg":
+                lats, lons = array("d"), array("d")
+            continue
+
+        path.pop()
+        parent = path[-1] if path else (None, None)
+
+        if tag == "trkpt":
+            lat, lon = elem.get("lat"), elem.get("lon")
+            if lat is not None and lon is not None:
+                if lats is None:
+                    lats, lons = array("d"), array("d")
+                lats.append(float(lat))
+                lons.append(float(lon))
+            # remove the track point from the tree, else the tree keeps growing
+            parent[1].clear()
+        elif tag == "trkseg" or (tag == "trk" and lats):
+            # track points outside of a trkseg element end with the trk element
+            if lats:
+                yield "trkseg", lats, lons
+            lats, lons = None, None
+            elem.clear()
+        elif tag == "wpt":
+            lat, lon = elem.get("lat"), elem.get("lon")
+            if lat is not None and lon is not None:
+                yield "wpt", float(lat), float(lon), elem.findtext("{*}name"), elem.findtext("{*}desc")
+            elem.clear()
+        elif tag == "desc" and parent[0] == "metadata":
+            yield "desc", elem.text or ""
+        elif tag in ["trk", "rte"]:
+            elem.clear()
+
+
+# first bytes of the files in the GPX cache, the format depends on the byte order of the machine
+GPX_CACHE_MAGIC = "fetchmap-gpx-1-{}\n".format(sys.byteorder).encode("ascii")
+
+
+def get_gpx_cache_file(filename):
+    """
+    Get the name of the cache file for a GPX file
+    :param filename: name of the GPX file
+    :return: name of the cache file
+    """
+    key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return os.path.join(Cachedir, "gpx", key + ".bin")
+
+
+def pack_string(s):
+    """
+    Pack a string for the GPX cache
+    :param s: string or None
+    :return: bytes
+    """
+    if s is None:
+        return struct.pack("<i", -1)
+    data = s.encode("utf-8")
+    return struct.pack("<i", len(data)) + data
+
+
+def unpack_string(data, pos):
+    """
+    Unpack a string from the GPX cache
+    :param data: cache file contents
+    :param pos: position of the string
+    :return: tuple of string or None and position after the string
+    """
+    length, = struct.unpack_from("<i", data, pos)
+    pos += 4
+    if length < 0:
+        return None, pos
+    return str(data[pos:pos + length], "utf-8"), pos + length
+
+
+def write_gpx_cache(filename, stat, items):
+    """
+    Write the contents of a GPX file to the GPX cache
+    :param filename: name of the GPX file
+    :param stat: os.stat_result of the GPX file
+    :param items: list of tuples from parse_gpx()
+    :return:
+    """
+    cachefile = get_gpx_cache_file(filename)
+    tmpfile = cachefile + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        with open(tmpfile, "wb") as fp:
+            fp.write(GPX_CACHE_MAGIC + struct.pack("<qqi", stat.st_mtime_ns, stat.st_size, len(items)))
+            for item in items:
+                if item[0] == "trkseg":
+                    fp.write(b"T" + struct.pack("<i", len(item[1])))
+                    item[1].tofile(fp)
+                    item[2].tofile(fp)
+                elif item[0] == "wpt":
+                    fp.write(b"W" + struct.pack("<dd", item[1], item[2]) + pack_string(item[3]) + pack_string(item[4]))
+                else:
+                    fp.write(b"D" + pack_string(item[1]))
+        os.replace(tmpfile, cachefile)
+    except OSError as e:
+        print("Cannot write GPX cache {}: {}".format(cachefile, e))
+
+
+def read_gpx_cache(filename, stat):
+    """
+    Read the contents of a GPX file from the GPX cache
+    :param filename: name of the GPX file
+    :param stat: os.stat_result of the GPX file
+    :return: list of tuples like from parse_gpx(), None if not cached or the GPX file has changed
+    """
+    try:
+        with open(get_gpx_cache_file(filename), "rb") as fp:
+            data = fp.read()
+    except OSError:
+        return None
+
+    pos = len(GPX_CACHE_MAGIC)
+    if data[:pos] != GPX_CACHE_MAGIC:
+        return None
+
+    try:
+        mtime, size, count = struct.unpack_from("<qqi", data, pos)
+        if mtime != stat.st_mtime_ns or size != stat.st_size:
+            return None
+        pos += struct.calcsize("<qqi")
+
+        items = []
+        data = memoryview(data)
+        for i in range(count):
+            kind = data[pos:pos + 1].tobytes()
+            pos += 1
+            if kind == b"T":
+                n, = struct.unpack_from("<i", data, pos)
+                pos += 4
+                lats, lons = array("d"), array("d")
+                lats.frombytes(data[pos:pos + n * 8])
+                lons.frombytes(data[pos + n * 8:pos + n * 16])
+                if len(lons) != n:
+                    return None
+                pos += n * 16
+                items.append(("trkseg", lats, lons))
+            elif kind == b"W":
+                lat, lon = struct.unpack_from("<dd", data, pos)
+                name, pos = unpack_string(data, pos + 16)
+                desc, pos = unpack_string(data, pos)
+                items.append(("wpt", lat, lon, name, desc))
+            else:
+                desc, pos = unpack_string(data, pos)
+                items.append(("desc", desc))
+    except (struct.error, ValueError):
+        # damaged cache file, read the GPX file again
+        return None
+    return items
+
+
+def read_gpx(filename):
+    """
+    Read a GPX file, from the GPX cache if the file hasn't changed since it was cached
+    :param filename: name of the GPX file
+    :return: list of tuples like from parse_gpx()
+    """
+    stat = os.stat(filename)
+    items = read_gpx_cache(filename, stat)
+    if items is None:
+        items = list(parse_gpx(filename))
+        write_gpx_cache(filename, stat, items)
+    return items
+
+
+class GPXParser:
+    """
+    Read a GPX file and draw it's track and waypoints on the map. Both are kept, as they are drawn on
+    each band of the map they reach into, the track segments as arrays of coordinates.
+    """
+
+    def __init__(self, draw, features="any"):
+        """
+        Constructor
+        :param draw: canvas
+        """
+        self.draw = draw
+        self.render_track = features in ["trk", "any"]
+        self.render_waypoints = features in ["wpt", "any"]
+        self.segments = []
+        self.pixels = None
+        self.pieces = None
+        self.waypoints = []
+        self.waypoint_index = None
+        self.waypoint_translation = []
+        self.metadata_desc = None
+
+    def parse(self, filename):
+        """
+        Read the tracks and waypoints from a GPX file
+        :param filename: name of the GPX file
+        :return:
+        """
+        for item in read_gpx(filename):
+            if item[0] == "trkseg":
+                if self.render_track:
+                    self.segments.append((item[1], item[2]))
+            elif self.render_waypoints:
+                if item[0] == "wpt":
+                    self.waypoints.append((item[1], item[2], item[3]))
+                    self.waypoint_translation.append((item[3], item[4]))
+                elif item[0] == "desc":
+                    self.metadata_desc = item[1]
+
+    def get_pixels(self):
+        """
+        Get the track segments in pixel coordinates on the map, projected once as the track is
+        drawn on each band of the map
+        :return: list of lists of pixel coordinate tuples
+        """
+        if self.pixels is None:
+            self.pixels = [self.draw.simplify(self.draw.latlons_to_map(lats, lons)) for lats, lons in self.segments]
+        return self.pixels
+
+    def get_pieces(self):
+        """
+        Get the track segments split into pieces of TRACK_PIECE_POINTS points, indexed by the rows
+        of the map they cover. Adjacent pieces share a segment, so that each joint between segments
+        is inside one of the pieces.
+        :return: BandIndex of lists of pixel coordinate tuples on the map
+        """
+        if self.pieces is None:
+            self.pieces = BandIndex(self.draw.height)
+            for points in self.get_pixels():
+                for start in range(0, len(points) - 1, TRACK_PIECE_POINTS):
+                    piece = points[max(start - 1, 0):start + TRACK_PIECE_POINTS + 1]
+                    ys = [y for x, y in piece]
+                    self.pieces.insert(min(ys), max(ys), piece)
+        return self.pieces
+
+    def draw_track(self):
+        """
+        Draw the pieces of the track segments reaching into the current band
+        :return:
+        """
+        linewidth = self.draw.style["linewidth"]["Track"]
+        linecolor = self.draw.style["linecolor"]["Track"]
+        top, bottom = self.draw.get_band_range(linewidth)
+        for points in self.get_pieces().get(top, bottom):
+            self.draw.polyline([(x, y - self.draw.top) for x, y in points], linewidth, linecolor)
+
+    def add_obstacles(self):
+        """
+        Keep town labels off the track and the waypoint markers
+        :return:
+        """
+        linewidth = self.draw.style["linewidth"]["Track"]
+        for points in self.get_pixels():
+            self.draw.add_line_obstacle(points, linewidth)
+
+        if self.render_waypoints:
+            for wpt in self.waypoints:
+                for box in self.draw.get_waypoint_boxes(wpt[0], wpt[1], wpt[2] if len(wpt) > 2 else None):
+                    self.draw.add_obstacle(box)
+
+    def get_waypoint_index(self):
+        """
+        Get the waypoints indexed by the rows of the map their markers and labels cover
+        :return: BandIndex of waypoints
+        """
+        if self.waypoint_index is None:
+            self.waypoint_index = BandIndex(self.draw.height)
+            for wpt in self.waypoints:
+                boxes = self.draw.get_waypoint_boxes(wpt[0], wpt[1], wpt[2] if len(wpt) > 2 else None)
+                self.waypoint_index.insert(min(box[1] for box in boxes), max(box[3] for box in boxes), wpt)
+        return self.waypoint_index
+
+    def draw_waypoints(self):
+        """
+        Draw the waypoint markers reaching into the current band
+        :return:
+        """
+        if self.render_waypoints:
+            top, bottom = self.draw.get_band_range(1)
+            for wpt in self.get_waypoint_index().get(top, bottom):
                 if len(wpt) > 2:
                     text = wpt[2]
                 else:
@@ -762,120 +2989,502 @@ class GPXParser(HTMLParser):
                 self.draw.waypoint(wpt[0], wpt[1], text)
 
 
-class OSMParser(HTMLParser):
+class OSMParser(HTMLParser):
+    """
+    Parse the Overpass output into a list of towns
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.towns = []
+        self.remarks = []
+        self.remark = None
+        self.kv = {}
+        self.id = None
+        self.lat = None
+        self.lon = None
+        super().__init__()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "node":
+            self.kv = {}
+            self.id = int(dict(attrs).get("id", 0))
+            self.lat, self.lon = latlon_from_attrs(attrs)
+
+        if tag == "tag":
+            key = None
+            val = None
+            for (k, v) in attrs:
+                if k == "k":
+                    key = v
+                    val = None
+                if k == "v":
+                    val = v
+            if key is not None:
+                self.kv[key] = val
+
+        if tag == "remark":
+            self.remark = ""
+
+    def handle_data(self, data):
+        if self.remark is not None:
+            self.remark += data
+
+    def handle_endtag(self, tag):
+        if tag == "remark" and self.remark is not None:
+            self.remarks.append(self.remark.strip())
+            self.remark = None
+
+        if tag == "node" and self.lat is not None and self.lon is not None:
+            town = get_town(self.id, self.lat, self.lon, self.kv)
+            if town:
+                self.towns.append(town)
+            self.kv = {}
+
+    def get_towns(self):
+        """
+        :return: list of towns in the order of the Overpass output
+        """
+        return self.towns
+
+    def get_remarks(self):
+        """
+        :return: list of the texts of the remark elements, the server reports errors like timeouts in them
+        """
+        return self.remarks
+
+
+def get_town(nodeid, lat, lon, kv):
+    """
+    Classify a place node of OpenStreetMap
+    :param nodeid: OSM node id
+    :param lat: latitude
+    :param lon: longitude
+    :param kv: dict of the tags of the node
+    :return: town dict, None for places without name
+    """
+    if "name" not in kv:
+        return None
+
+    townclass = "towns"
+    population = 0
+
+    if "place" in kv and kv["place"] == "city":
+        townclass = "cities"
+
+    if "capital" in kv:
+        townclass = "capitals"
+
+    if "population" in kv:
+        try:
+            population = to_int(kv["population"])
+        except ValueError as e:
+            print("{}: kv={}".format(e, kv))
+
+    return {
+        "id": nodeid,
+        "name": kv["name"],
+        "lat": lat,
+        "lon": lon,
+        "population": population,
+        "class": townclass,
+    }
+
+
+def get_sorted_towns(towns):
+    """
+    Sort a list of towns into classes, and the towns of each class by size of population (largest first)
+    :param towns: list of town dicts
+    :return: dict of lists of towns by class
+    """
+    townlist = {
+        "capitals": [],
+        "cities": [],
+        "towns": [],
+    }
+    for town in towns:
+        townlist[town["class"]].append(town)
+    for towntype in townlist.keys():
+        townlist[towntype].sort(key=lambda d: d["population"], reverse=True)
+    return townlist
+
+
+def get_luminance_mean(histogram):
+    """
+    Calculate the mean luminance from a histogram, rounded like ImageEnhance.Contrast does
+    :param histogram: list of pixel counts for each luminance value
+    :return: mean luminance
+    """
+    return int(sum(i * count for i, count in enumerate(histogram)) / sum(histogram) + 0.5)
+
+
+def to_float32(f):
+    """
+    Round a number to single precision
+    :param f: number
+    :return: float with the value of the single precision number
+    """
+    return struct.unpack("f", struct.pack("f", f))[0]
+
+
+def blend_value(v1, v2, alpha):
+    """
+    Blend two pixel values like Image.blend() does, in single precision and truncated
+    :param v1: pixel value of the first image
+    :param v2: pixel value of the second image
+    :param alpha: interpolation factor
+    :return: pixel value
+    """
+    v = to_float32(v1 + to_float32(to_float32(alpha) * (v2 - v1)))
+    return min(max(int(v), 0), 255)
+
+
+def get_color_table(adjust, mean):
+    """
+    Get a lookup table doing the contrast and brightness adjustment in one pass
+    :param adjust: dict with the factors, keys: contrast, brightness
+    :param mean: mean luminance for the contrast adjustment
+    :return: list of 256 pixel values
+    """
+    table = list(range(256))
+    # Image.blend() returns the second image unchanged for a factor of 1
+    if adjust.get("contrast", 1) != 1:
+        table = [blend_value(mean, v, adjust["contrast"]) for v in table]
+    if adjust.get("brightness", 1) != 1:
+        table = [blend_value(0, v, adjust["brightness"]) for v in table]
+    return table
+
+
+def adjust_colors(image, adjust, mean=None):
+    """
+    Adjust saturation, contrast and brightness of an image. The result is the same as with ImageEnhance,
+    but contrast and brightness are applied in one pass with a lookup table, and the mean luminance for the
+    contrast adjustment can be passed, so that all bands of a map get the same.
+    :param image: RGB image
+    :param adjust: dict with the factors, keys: saturation, contrast, brightness
+    :param mean: mean luminance after the saturation adjustment, None for the mean luminance of the image
+    :return: adjusted image
+    """
+    if adjust.get("saturation", 1) != 1:
+        image = Image.blend(image.convert("L").convert("RGB"), image, adjust["saturation"])
+    if adjust.get("contrast", 1) != 1 or adjust.get("brightness", 1) != 1:
+        if mean is None and "contrast" in adjust:
+            mean = get_luminance_mean(image.convert("L").histogram())
+        image = image.point(get_color_table(adjust, mean) * 3)
+    return image
+
+
+def get_map_histogram(draw, swx, swy, nex, ney, zoom, bandrows):
+    """
+    Get the luminance histogram of the saturation adjusted map tile by tile, without stitching it
+    :param draw: canvas
+    :param swx: x tile coordinate for the South/West corner tile
+    :param swy: y tile coordinate for the South/West corner tile
+    :param nex: x tile coordinate for the North/East corner tile
+    :param ney: y tile coordinate for the North/East corner tile
+    :param zoom: zoom factor
+    :param bandrows: number of tile rows read from the cache at once
+    :return: list of pixel counts for each luminance value
+    """
+    adjust = {k: v for k, v in draw.style["mapcoloradjust"].items() if k == "saturation"}
+    histogram = [0] * 256
+    empty = (nex - swx + 1) * (swy - ney + 1)
+
+    for top in range(ney, swy + 1, bandrows):
+        for tx, ty, tile in fetch_tiles(swx, min(top + bandrows - 1, swy), nex, top, zoom):
+            if tile:
+                empty -= 1
+                tilehist = adjust_colors(tile, adjust).convert("L").histogram()
+                histogram = [a + b for a, b in zip(histogram, tilehist)]
+
+    # tiles that failed to download stay black
+    histogram[0] += empty * tilesize * tilesize
+    return histogram
+
+
+def stitch_map(draw, swx, swy, nex, ney, zoom, mean=None):
+    """
+    Retreive and stitch the tiles for range of tiles
+    :param draw: canvas
+    :param swx: x tile coordinate for the South/West corner tile
+    :param swy: y tile coordinate for the South/West corner tile
+    :param nex: x tile coordinate for the North/East corner tile
+    :param ney: y tile coordinate for the North/East corner tile
+    :param zoom: zoo factor
+    :param mean: mean luminance of the whole map for the contrast adjustment, None to use the tile range.
+                 The tiles were read for the mean already, so they don't count as cache hits again.
+    :return:
+    """
+    # tiles don't overlap, so the order of pasting doesn't matter
+    for tx, ty, tile in fetch_tiles(swx, swy, nex, ney, zoom, count=mean is None):
+        if tile:
+            draw.image.paste(tile, ((tx - swx) * tilesize, (ty - ney) * tilesize))
+
+    if "mapcoloradjust" in draw.style:
+        draw.set_image(adjust_colors(draw.image, draw.style["mapcoloradjust"], mean))
+
+
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+
+
+def read_wkb_header(wkb, pos):
+    """
+    Read the byte order and geometry type of a WKB geometry
+    :param wkb: WKB data
+    :param pos: offset of the geometry in the data
+    :return: tuple of struct byte order, base geometry type, values per point and offset after the header
+    """
+    endian = "<" if wkb[pos] == 1 else ">"
+    gtype, = struct.unpack_from(endian + "I", wkb, pos + 1)
+    dims = 2
+    # old OGC 2.5D and EWKB flags
+    if gtype & 0x80000000:
+        dims += 1
+    if gtype & 0x40000000:
+        dims += 1
+    gtype &= 0x0fffffff
+    # ISO types add 1000 for Z, 2000 for M and 3000 for ZM
+    if gtype >= 1000:
+        dims += (1, 1, 2)[gtype // 1000 - 1]
+    return endian, gtype % 1000, dims, pos + 5
+
+
+def read_wkb_lines(wkb):
+    """
+    Decode the points of a LineString or MultiLineString from WKB in bulk
+    :param wkb: WKB data
+    :return: list of tuples of latitude and longitude arrays, one for each line, None for other geometries
+    """
+    endian, gtype, dims, pos = read_wkb_header(wkb, 0)
+    if gtype == WKB_LINESTRING:
+        # a LineString is read like a MultiLineString with one part
+        count, pos = 1, 0
+    elif gtype == WKB_MULTILINESTRING:
+        count, = struct.unpack_from(endian + "I", wkb, pos)
+        pos += 4
+    else:
+        return None
+
+    data = memoryview(wkb)
+    lines = []
+    for _ in range(count):
+        endian, gtype, dims, pos = read_wkb_header(wkb, pos)
+        if gtype != WKB_LINESTRING:
+            return None
+        npoints, = struct.unpack_from(endian + "I", wkb, pos)
+        pos += 4
+        end = pos + npoints * dims * 8
+        coords = array("d")
+        coords.frombytes(data[pos:end])
+        if (endian == "<") != (sys.byteorder == "little"):
+            coords.byteswap()
+        pos = end
+        # points are x, y (, z, m)
+        lines.append((coords[1::dims], coords[0::dims]))
+    return lines
+
+
+# version of the road index format, the points are stored in the byte order of the machine
+ROAD_INDEX_VERSION = "1-{}".format(sys.byteorder)
+
+
+def get_road_index_file(shapefile):
+    """
+    Get the name of the road index for a shapefile
+    :param shapefile: name of the shapefile
+    :return: name of the index file
+    """
+    key = hashlib.sha1(os.path.abspath(shapefile).encode("utf-8")).hexdigest()
+    return os.path.join(Cachedir, "roads", "{}-{}.sqlite".format(Path(shapefile).stem, key[:12]))
+
+
+def get_road_tier(zoom):
+    """
+    Get the tier of the road index for a zoom factor
+    :param zoom: zoom factor
+    :return: tuple of the lowest zoom factor of the tier and the zoom factor of its bucket tiles
+    """
+    tier = ROAD_INDEX_TIERS[0]
+    for t in ROAD_INDEX_TIERS:
+        if t[0] <= zoom:
+            tier = t
+    return tier
+
+
+def get_road_feature_level(feature):
+    """
+    Get the level of a road from the "level" field of the shapefile, or the "class" field
+    :param feature: OGR feature
+    :return: level
+    """
+    try:
+        return feature.GetField("level")
+    except:
+        return feature.GetField("class")
+
+
+def build_road_index(shapefile, filename):
     """
-    Parse the Overpass output and sort the information according to classes and size of population
+    Build the road index for a shapefile. The roads are stored once per tier, leaving out the levels
+    too minor for the tier and simplified for its highest zoom factor, with a list of the bucket tiles
+    their bounding box covers.
+    :param shapefile: name of the shapefile
+    :param filename: name of the index file
+    :return: list of the number of roads for each tier
     """
+    drv = ogr.GetDriverByName("ESRI Shapefile")
+    shp = drv.Open(shapefile, 0)
+    if shp is None:
+        raise IOError("cannot open shapefile {}".format(shapefile))
+    shplayer = shp.GetLayer()
+    stat = os.stat(shapefile)
+
+    # the index is built in a temporary file, so a render never sees an incomplete index
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpfile = filename + ".tmp"
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    db = sqlite3.connect(tmpfile)
+    db.executescript("""
+        CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE roads (id INTEGER PRIMARY KEY, level TEXT, points BLOB);
+        CREATE TABLE road_buckets (tier INTEGER, x INTEGER, y INTEGER, road INTEGER,
+                                   PRIMARY KEY (tier, x, y, road)) WITHOUT ROWID;
+    """)
+    db.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)",
+                   [("version", ROAD_INDEX_VERSION), ("shapefile", os.path.abspath(shapefile)),
+                    ("mtime", str(stat.st_mtime_ns)), ("size", str(stat.st_size))])
+
+    counts = [0] * len(ROAD_INDEX_TIERS)
+    road = 0
+    for feature in shplayer:
+        level = get_road_feature_level(feature)
+        geometry = feature.GetGeometryRef()
+        lines = read_wkb_lines(geometry.ExportToWkb(ogr.wkbNDR)) if geometry is not None else None
+        if lines is None:
+            continue
 
-    def __init__(self, draw):
-        """
-        Constructor
-        :param draw: canvas
-        """
-        self.draw = draw
-        self.townlist = {
-            "capitals": [],
-            "cities": [],
-            "towns": [],
-        }
-        self.kv = {}
-        self.lat = None
-        self.lon = None
-        super().__init__()
-
-    def handle_starttag(self, tag, attrs):
-        if tag == "node":
-            self.kv = {}
-            self.lat, self.lon = latlon_from_attrs(attrs)
+        for lats, lons in lines:
+            if len(lats) < 2:
+                continue
+            for i, (minzoom, bucketzoom) in enumerate(ROAD_INDEX_TIERS):
+                if ROAD_LEVEL_MINZOOM.get(level, 0) > minzoom:
+                    continue
+
+                # the last tier keeps all points, for any zoom factor
+                if i + 1 < len(ROAD_INDEX_TIERS):
+                    xs, ys = deg2pixels(lats, lons, ROAD_INDEX_TIERS[i + 1][0] - 1)
+                    keep = get_simplified_indices(list(zip(xs, ys)), ROAD_INDEX_TOLERANCE)
+                    points = array("d", [lats[k] for k in keep] + [lons[k] for k in keep])
+                else:
+                    points = lats + lons
 
-        if tag == "tag":
-            key = None
-            val = None
-            for (k, v) in attrs:
-                if k == "k":
-                    key = v
-                    val = None
-                if k == "v":
-                    val = v
-            if key is not None:
-                self.kv[key] = val
+                road += 1
+                counts[i] += 1
+                db.execute("INSERT INTO roads (id, level, points) VALUES (?, ?, ?)", (road, level, points.tobytes()))
 
-    def handle_endtag(self, tag):
-        if tag == "node" and self.lat is not None and self.lon is not None:
-            townclass = "towns"
-            population = 0
+                maxtile = 2 ** bucketzoom - 1
+                x1, y1 = deg2num(max(lats), min(lons), bucketzoom)
+                x2, y2 = deg2num(min(lats), max(lons), bucketzoom)
+                db.executemany("INSERT INTO road_buckets (tier, x, y, road) VALUES (?, ?, ?, ?)",
+                               [(minzoom, x, y, road)
+                                for x in range(max(x1, 0), min(x2, maxtile) + 1)
+                                for y in range(max(y1, 0), min(y2, maxtile) + 1)])
 
-            if "place" in self.kv and self.kv["place"] == "city":
-                townclass = "cities"
+    db.commit()
+    db.close()
+    os.replace(tmpfile, filename)
+    return counts
 
-            if "capital" in self.kv:
-                townclass = "capitals"
 
-            if "population" in self.kv:
-                try:
-                    population = to_int(self.kv["population"])
-                except ValueError as e:
-                    print("{}: kv={}".format(e, self.kv))
-
-            if "name" in self.kv:
-                town = {
-                    "name": self.kv["name"],
-                    "lat": self.lat,
-                    "lon": self.lon,
-                    "population": population,
-                    "class": townclass,
-                }
-
-                self.townlist[townclass].append(town)
-            # self.canvas.town_label(self.lat, self.lon, self.kv["name"])
-            self.kv = {}
+class RoadIndex:
+    """
+    Index of the roads of a shapefile built by build_road_index(), so that a render reads only the
+    roads of the tiles it needs, without GDAL
+    """
 
-    def get_sorted_towns(self):
+    def __init__(self, filename):
         """
-        sort the list of towns in each class by size of population (largest first)
-        :return: list of towns
+        Constructor
+        :param filename: name of the index file
         """
-        for towntype in self.townlist.keys():
-            self.townlist[towntype].sort(key=lambda d: d["population"], reverse=True)
-        # print (towntype, self.townlist[towntype])
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.metadata = dict(self.db.execute("SELECT name, value FROM metadata"))
 
-        return self.townlist
+    def is_current(self, shapefile):
+        """
+        Check if the index was built by this version for the current contents of a shapefile
+        :param shapefile: name of the shapefile, it may not exist
+        :return: True if the index is usable
+        """
+        if self.metadata.get("version") != ROAD_INDEX_VERSION:
+            return False
+        if not os.path.exists(shapefile):
+            return True
+        stat = os.stat(shapefile)
+        return self.metadata.get("mtime") == str(stat.st_mtime_ns) and self.metadata.get("size") == str(stat.st_size)
+
+    def get_roads(self, swx, swy, nex, ney, zoom):
+        """
+        Get the roads of the buckets covering a range of tiles, in the order of the shapefile
+        :param swx: x tile coordinate for the South/West corner tile
+        :param swy: y tile coordinate for the South/West corner tile
+        :param nex: x tile coordinate for the North/East corner tile
+        :param ney: y tile coordinate for the North/East corner tile
+        :param zoom: zoom factor
+        :return: generator of tuples of road id, level, latitude array and longitude array
+        """
+        minzoom, bucketzoom = get_road_tier(zoom)
+        x1, y2, x2, y1 = get_cell_range(swx, swy, nex, ney, zoom, bucketzoom)
+        for road, level, data in self.db.execute("SELECT id, level, points FROM roads WHERE id IN "
+                                                 "(SELECT road FROM road_buckets WHERE tier=? AND x BETWEEN ? AND ? "
+                                                 "AND y BETWEEN ? AND ?) ORDER BY id", (minzoom, x1, x2, y1, y2)):
+            points = array("d")
+            points.frombytes(data)
+            count = len(points) // 2
+            yield road, level, points[:count], points[count:]
+
+    def close(self):
+        """
+        Close the index file
+        :return:
+        """
+        self.db.close()
 
 
-def stitch_map(draw, swx, swy, nex, ney, zoom):
+def open_road_index(shapefile):
     """
-    Retreive and stitch the tiles for range of tiles
-    :param draw: canvas
-    :param swx: x tile coordinate for the South/West corner tile
-    :param swy: y tile coordinate for the South/West corner tile
-    :param nex: x tile coordinate for the North/East corner tile
-    :param ney: y tile coordinate for the North/East corner tile
-    :param zoom: zoo factor
-    :return:
+    Open the road index of a shapefile if it exists and is up to date
+    :param shapefile: name of the shapefile
+    :return: RoadIndex instance or None
     """
-    offx = 0
-    offy = 0
+    filename = get_road_index_file(shapefile)
+    if not os.path.exists(filename):
+        return None
 
-    for ty in range(ney, swy + 1):
-        for tx in range(swx, nex + 1):
-            # print(tx, ty, offx, offy)
-            tile = fetch_tile(tx, ty, zoom)
-            if tile:
-                draw.image.paste(tile, (offx, offy))
-            offx += tilesize
-        offy += tilesize
-        offx = 0
+    index = RoadIndex(filename)
+    if not index.is_current(shapefile):
+        print("Road index for {} is out of date, run \"fetchmap.py roads build\"".format(shapefile))
+        index.close()
+        return None
+    return index
 
-    if "mapcoloradjust" in draw.style:
-        ta = draw.style["mapcoloradjust"]
-        img = draw.image.convert("RGB")
-        if "saturation" in ta:
-            img = ImageEnhance.Color(img).enhance(ta["saturation"])
-        if "contrast" in ta:
-            img = ImageEnhance.Contrast(img).enhance(ta["contrast"])
-        if "brightness" in ta:
-            img = ImageEnhance.Brightness(img).enhance(ta["brightness"])
-        draw.set_image(img.convert("RGBA"))
+
+def get_street_linetype(draw, level):
+    """
+    Get the line type of the style for the level of a road
+    :param draw: canvas
+    :param level: level of the road from the shapefile
+    :return: line type
+    """
+    if level not in draw.style["linewidth"]:
+        print("Missing style for level {}".format(level))
+        return "Other"
+    return level
 
 
 def draw_streets(draw, swx, swy, nex, ney, zoom):
@@ -889,8 +3498,13 @@ def draw_streets(draw, swx, swy, nex, ney, zoom):
     :param zoom: zoom factor
     :return:
     """
+    if road_index:
+        for road, level, lats, lons in road_index.get_roads(swx, swy, nex, ney, zoom):
+            draw.multiline(lats, lons, linetype=get_street_linetype(draw, level), key=road)
+        return
+
     shapefile = get_path(args.shapefile)
-    if os.path.exists(shapefile):
+    if os.path.exists(shapefile) and have_gdal():
         drv = ogr.GetDriverByName("ESRI Shapefile")
         shp = drv.Open(shapefile, 0)
         shplayer = shp.GetLayer()
@@ -902,36 +3516,25 @@ def draw_streets(draw, swx, swy, nex, ney, zoom):
         shplayer.SetSpatialFilter(ogr.CreateGeometryFromWkt(wkt))
 
         for feature in shplayer:
-            try:
-                level = feature.GetField("level")
-            except:
-                level = feature.GetField("class")
+            level = get_road_feature_level(feature)
 
-            segment = json.loads(feature.GetGeometryRef().ExportToJson())
-
-            ftype = segment["type"]
-            if ftype not in ["LineString", "MultiLineString"]:
-                print("Unexpected geometry type {}".format(ftype))
+            geometry = feature.GetGeometryRef()
+            lines = read_wkb_lines(geometry.ExportToWkb(ogr.wkbNDR))
+            if lines is None:
+                print("Unexpected geometry type {}".format(geometry.GetGeometryName()))
                 continue
 
-            if level not in draw.style["linewidth"]:
-                print("Missing style for level {}".format(level))
-                level = "Other"
-
-            coords = segment["coordinates"]
-            if ftype == "LineString":
-                draw.multiline(coords, linetype=level)
-            elif ftype == "MultiLineString":
-                for c in coords:
-                    draw.multiline(c, linetype=level)
+            level = get_street_linetype(draw, level)
+            for part, (lats, lons) in enumerate(lines):
+                draw.multiline(lats, lons, linetype=level, key=(feature.GetFID(), part))
 
 
-def draw_gpx_tracks(draw, gpxfiles):
+def read_gpx_files(draw, gpxfiles):
     """
-    Draw the tracks for one or more gpxfiles
+    Read the tracks and waypoints of one or more gpxfiles
     :param draw: canvas
     :param gpxfiles: colon-separated list of GPX file names
-    :return:
+    :return: list of GPXParser
     """
 
     gpxinstances = []
@@ -953,15 +3556,45 @@ def draw_gpx_tracks(draw, gpxfiles):
             print("GPX file »{}« does not exist, ignored".format(gpxfile))
             continue
 
-        with open(gpxfile, "r") as fp:
-            gpxparser = GPXParser(draw, features)
-            gpxparser.feed(fp.read())
-            gpxparser.close()
-            gpxinstances.append(gpxparser)
+        gpxparser = GPXParser(draw, features)
+        try:
+            gpxparser.parse(gpxfile)
+        except ElementTree.ParseError as e:
+            print("GPX file »{}« is invalid, ignored: {}".format(gpxfile, e))
+            continue
+        gpxinstances.append(gpxparser)
 
     return gpxinstances
 
 
+def draw_gpx_tracks(gpxlist):
+    """
+    Draw the tracks of the GPX files
+    :param gpxlist: list of GPXParser
+    :return:
+    """
+
+    if gpxlist is None:
+            return
+
+    for gpx in gpxlist:
+        gpx.draw_track()
+
+
+def add_gpx_obstacles(gpxlist):
+    """
+    Keep town labels off the tracks and waypoints of the GPX files
+    :param gpxlist: list of GPXParser
+    :return:
+    """
+
+    if gpxlist is None:
+            return
+
+    for gpx in gpxlist:
+        gpx.add_obstacles()
+
+
 def draw_gpx_waypoints(gpxlist):
     """
     Draw the marker of the GPX tracks
@@ -976,9 +3609,9 @@ def draw_gpx_waypoints(gpxlist):
         gpx.draw_waypoints()
 
 
-def draw_town_labels(draw, swx, swy, nex, ney, zoom):
+def place_town_labels(draw, swx, swy, nex, ney, zoom):
     """
-    Draw the town markers and names
+    Place the town markers and names on the map, before drawing them band by band
     :param draw: canvas
     :param swx: x tile coordinate for the South/West corner tile
     :param swy: y tile coordinate for the South/West corner tile
@@ -987,16 +3620,203 @@ def draw_town_labels(draw, swx, swy, nex, ney, zoom):
     :param zoom: zoom factor
     :return:
     """
-    osmdata = fetch_labels(swx, swy, nex, ney, zoom)
-    if osmdata:
-        osm = OSMParser(draw)
-        osm.feed(osmdata)
-        osm.close()
+    towns = get_sorted_towns(fetch_labels(swx, swy, nex, ney, zoom))
+    for townclass in ["capitals", "cities", "towns"]:
+        for t in towns[townclass]:
+            draw.town_label(t)
+
+
+def render_map(draw, gpxlist, swx, swy, nex, ney, zoom, bandrows, writer=None):
+    """
+    Render the map in horizontal bands of tile rows, so that only one band has to be kept in memory
+    :param draw: canvas, with the image of the first band set
+    :param gpxlist: list of GPXParser
+    :param swx: x tile coordinate for the South/West corner tile
+    :param swy: y tile coordinate for the South/West corner tile
+    :param nex: x tile coordinate for the North/East corner tile
+    :param ney: y tile coordinate for the North/East corner tile
+    :param zoom: zoom factor
+    :param bandrows: number of tile rows per band
+    :param writer: map writer the bands are passed to, None to discard them
+    :return:
+    """
+    # the contrast of all bands is adjusted to the mean luminance of the whole map
+    mean = None
+    if ney + bandrows <= swy and draw.style.get("mapcoloradjust", {}).get("contrast", 1) != 1:
+        mean = get_luminance_mean(get_map_histogram(draw, swx, swy, nex, ney, zoom, bandrows))
+
+    for top in range(ney, swy + 1, bandrows):
+        bottom = min(top + bandrows - 1, swy)
+        if top > ney:
+            draw.set_band(Image.new("RGB", ((nex - swx + 1) * tilesize, (bottom - top + 1) * tilesize)),
+                          (top - ney) * tilesize)
+
+        stitch_map(draw, swx, bottom, nex, top, zoom, mean)
+
+        # streets of the tile rows next to the band may reach into it with their line width
+        draw_streets(draw, swx, min(bottom + 1, swy), nex, max(top - 1, ney), zoom)
+
+        draw_gpx_tracks(gpxlist)
+        draw.draw_labels()
+        draw_gpx_waypoints(gpxlist)
+
+        if writer:
+            writer.write(draw.image)
+
+
+class ImageWriter:
+    """
+    Collect the bands of the map in one image and save it with PIL, for file formats that can't be
+    written band by band
+    """
+
+    def __init__(self, filename, size):
+        """
+        Constructor
+        :param filename: output file name
+        :param size: map size in pixels
+        """
+        self.filename = filename
+        self.size = tuple(size)
+        self.image = None
+        self.top = 0
+
+    def write(self, band):
+        """
+        Add a band to the map
+        :param band: RGB image
+        :return:
+        """
+        if self.image is None and band.size == self.size:
+            # rendered in one band, nothing to copy
+            self.image = band
+        else:
+            if self.image is None:
+                self.image = Image.new("RGB", self.size)
+            self.image.paste(band, (0, self.top))
+        self.top += band.height
+
+    def close(self):
+        self.image.save(self.filename)
+
+
+class PNGWriter:
+    """
+    Write a PNG file band by band. PIL does the filtering of the scanlines of each band, the compression
+    runs across all bands.
+    """
+
+    def __init__(self, filename, size):
+        """
+        Constructor
+        :param filename: output file name
+        :param size: map size in pixels
+        """
+        self.fp = open(filename, "wb")
+        self.compressor = zlib.compressobj(6)
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, 2, 0, 0, 0))
+
+    def write_chunk(self, tag, data):
+        """
+        Write a PNG chunk
+        :param tag: chunk type
+        :param data: chunk data
+        :return:
+        """
+        self.fp.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data)))
+
+    def write(self, band):
+        """
+        Append a band to the PNG file
+        :param band: RGB image
+        :return:
+        """
+        # let PIL filter the scanlines, but without compression
+        buf = io.BytesIO()
+        band.save(buf, "PNG", compress_level=0)
+        png = buf.getvalue()
+        idat = []
+        pos = 8
+        while pos < len(png):
+            length, tag = struct.unpack(">I4s", png[pos:pos + 8])
+            if tag == b"IDAT":
+                idat.append(png[pos + 8:pos + 8 + length])
+            pos += length + 12
+        scanlines = bytearray(zlib.decompress(b"".join(idat)))
+
+        # the filters of the first scanline refer to the last scanline of the previous band in the
+        # PNG file, rewrite them for a preceding scanline of zeros like PIL assumed
+        stride = band.width * 3
+        ftype = scanlines[0]
+        if ftype == 2:
+            # up: unfiltered
+            scanlines[0] = 0
+        elif ftype == 3:
+            # average: unfilter the half of the left pixel
+            for i in range(4, stride + 1):
+                scanlines[i] = (scanlines[i] + (scanlines[i - 3] >> 1)) & 0xff
+            scanlines[0] = 0
+        elif ftype == 4:
+            # paeth: same as sub
+            scanlines[0] = 1
+
+        data = self.compressor.compress(scanlines)
+        if data:
+            self.write_chunk(b"IDAT", data)
+
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.fp.close()
+
+
+class PPMWriter:
+    """
+    Write a PPM file band by band
+    """
+
+    def __init__(self, filename, size):
+        """
+        Constructor
+        :param filename: output file name
+        :param size: map size in pixels
+        """
+        self.fp = open(filename, "wb")
+        self.fp.write("P6\n{} {}\n255\n".format(size[0], size[1]).encode("ascii"))
+
+    def write(self, band):
+        """
+        Append a band to the PPM file
+        :param band: RGB image
+        :return:
+        """
+        self.fp.write(band.tobytes())
+
+    def close(self):
+        self.fp.close()
+
+
+# file formats that can be written band by band
+MapWriters = {
+    ".png": PNGWriter,
+    ".ppm": PPMWriter,
+    ".pnm": PPMWriter,
+}
 
-        towns = osm.get_sorted_towns()
-        for townclass in ["capitals", "cities", "towns"]:
-            for t in towns[townclass]:
-                draw.town_label(t)
+
+def open_map_writer(filename, size, banded):
+    """
+    Get the writer for the map file
+    :param filename: output file name
+    :param size: map size in pixels
+    :param banded: True if the map is rendered in more than one band
+    :return: writer instance
+    """
+    suffix = Path(filename).suffix.lower()
+    if banded and suffix in MapWriters:
+        return MapWriters[suffix](filename, size)
+    return ImageWriter(filename, size)
 
 
 def waypoints_as_html(gpxlist, filename, size):
@@ -1074,16 +3894,318 @@ def get_cmdline_args():
     parser.add_argument("-d", "--dpi", type=int, default=300, help="print resolution")
     parser.add_argument("-m", "--margin", type=int, default=5, help="width of paper margins in mm")
     parser.add_argument("-z", "--zoom", type=int, default=-1, help="zoom level (mutually exclusive to paper specs)")
+    parser.add_argument("-b", "--band-height", type=int, default=DEFAULT_BAND_HEIGHT,
+                        help="render the map in bands of this height in pixels to save memory (default: all at once)")
+    parser.add_argument("--simplify", type=float, default=DEFAULT_SIMPLIFY,
+                        help="simplify tracks and streets, removing points closer than this number of pixels "
+                             "to the simplified line, e.g. 0.5")
+    parser.add_argument("--timings", default=False, help="print the duration of the phases of the run",
+                        action="store_true")
+    add_download_arguments(parser)
     parser.add_argument("-D", "--dryrun", default=False, help="dry run, don't download anything", action="store_true")
-    parser.add_argument("-s", "--tilesource", type=str, default=DEFAULT_TILESERVER,
-                        choices=sorted(TileserverList.keys()), help="tile server to use")
-    parser.add_argument("-t", "--tileserver", type=str, help="URL for the tileserver")
+    parser.add_argument("-O", "--offline", default=False, help="don't download anything, use cached data only",
+                        action="store_true")
     parser.add_argument("-g", "--gpx", type=str, action="append", help="GPX file: [(trk|wpt|any),]file.gpx - may be specified multiple times")
     parser.add_argument("-S", "--shapefile", type=str, default=DEFAULT_SHAPEFILE, help="shapefile for streets")
     parser.add_argument("-o", "--out", type=str, default="mapfile-{}.jpg", help="name of output file")
     return parser.parse_args()
 
 
+def add_download_arguments(parser):
+    """
+    Add the command line parameters for the tile source, the cache and downloads
+    :param parser: argparse.ArgumentParser instance
+    :return:
+    """
+    parser.add_argument("-s", "--tilesource", type=str, default=DEFAULT_TILESERVER,
+                        choices=sorted(TileserverList.keys()), help="tile server to use")
+    parser.add_argument("-t", "--tileserver", type=str, help="URL for the tileserver")
+    parser.add_argument("-j", "--connections", type=int, default=DEFAULT_HOST_CONNECTIONS,
+                        help="maximum number of concurrent connections per server")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="maximum number of requests per second to the tile server (default: {})".format(
+                            DEFAULT_RATE_LIMIT))
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="number of retries of failed requests")
+    parser.add_argument("-C", "--cache", type=str, default=DEFAULT_TILECACHE, choices=sorted(TileCaches.keys()),
+                        help="tile cache backend")
+    parser.add_argument("--cache-limit", type=to_bytes, default=None,
+                        help="maximum size of the tile cache, e.g. 2G - least recently used tiles are removed")
+    parser.add_argument("--missing-ttl", type=float, default=DEFAULT_MISSING_TTL,
+                        help="hours until tiles the server reported as not existing are requested again")
+
+
+def to_zoom_range(s):
+    """
+    Get a range of zoom factors from a string like "5-12"
+    :param s: zoom factor or range of zoom factors
+    :return: range
+    """
+    m = re.match(r"^(\d+)(?:-(\d+))?$", s)
+    if not m:
+        raise ValueError("invalid zoom range {}".format(s))
+    zmin = int(m.group(1))
+    zmax = int(m.group(2)) if m.group(2) else zmin
+    return range(min(zmin, zmax), max(zmin, zmax) + 1)
+
+
+def get_seed_cmdline_args():
+    """
+    Command line handling for the "seed" subcommand
+    :return: args structure with parameters
+    """
+    parser = argparse.ArgumentParser(prog="fetchmap.py seed",
+                                     description="download tiles and town names of a bounding box into the cache")
+    parser.add_argument("west", type=float, help="West coordinate of the bounding box")
+    parser.add_argument("south", type=float, help="South coordinate of the bounding box")
+    parser.add_argument("east", type=float, help="East coordinate of the bounding box")
+    parser.add_argument("north", type=float, help="North coordinate of the bounding box")
+    parser.add_argument("-z", "--zoom", type=to_zoom_range, required=True, help="zoom level or range, e.g. 5-12")
+    parser.add_argument("--no-labels", default=False, help="don't download town names", action="store_true")
+    add_download_arguments(parser)
+    args = parser.parse_args(sys.argv[2:])
+    args.dryrun = False
+    args.offline = False
+    return args
+
+
+def open_tilesource(args):
+    """
+    Select the tile server, open its cache and set up the download limits
+    :param args: args structure with the parameters from add_download_arguments()
+    :return: id of the map style
+    """
+    global tileshandle, tileserver, tile_cache, tile_ttl
+
+    if args.tileserver:
+        tileshandle = "user"
+        tileserver = args.tileserver
+        style = "default"
+    else:
+        tileshandle = args.tilesource
+        tileserver = TileserverList[args.tilesource]["url"]
+        style = TileserverList[args.tilesource]["style"]
+
+    source = TileserverList.get(tileshandle, {})
+    cachelimit = args.cache_limit
+    if cachelimit is None:
+        cachelimit = source.get("cachelimit", DEFAULT_CACHE_LIMIT)
+    if cachelimit is not None:
+        cachelimit = to_bytes(cachelimit)
+    tile_cache = TileCaches[args.cache](Cachedir, tileshandle, tileserver, cachelimit)
+    tile_ttl = source.get("ttl", DEFAULT_TILE_TTL)
+
+    if args.rate is None:
+        args.rate = source.get("ratelimit", DEFAULT_RATE_LIMIT)
+    set_rate_limit(OVERPASS_URI, OVERPASS_RATE_LIMIT)
+
+    return style
+
+
+def get_cache_cmdline_args():
+    """
+    Command line handling for the "cache" subcommand
+    :return: args structure with parameters
+    """
+    parser = argparse.ArgumentParser(prog="fetchmap.py cache", description="manage the tile cache")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    migrate = commands.add_parser("migrate", help="move tiles from the directory cache into MBTiles files")
+    migrate.add_argument("-s", "--tilesource", type=str, action="append",
+                         help="tile source to migrate (default: all) - may be specified multiple times")
+    migrate.add_argument("--delete", default=False, help="remove the tile files after migration", action="store_true")
+
+    stats = commands.add_parser("stats", help="show the size and usage of the tile cache")
+    stats.add_argument("-s", "--tilesource", type=str, action="append",
+                       help="tile source (default: all) - may be specified multiple times")
+
+    prune = commands.add_parser("prune", help="remove tiles from the tile cache")
+    prune.add_argument("-s", "--tilesource", type=str, action="append",
+                       help="tile source (default: all) - may be specified multiple times")
+    prune.add_argument("-z", "--zoom", type=int, action="append",
+                       help="remove tiles of this zoom level - may be specified multiple times")
+    prune.add_argument("--older-than", type=float, help="remove tiles not used for this number of days")
+    prune.add_argument("--limit", type=to_bytes, help="remove least recently used tiles down to this size, e.g. 2G")
+    prune.add_argument("--missing", default=False, action="store_true",
+                       help="forget about tiles the server reported as not existing")
+    return parser.parse_args(sys.argv[2:])
+
+
+def get_roads_cmdline_args():
+    """
+    Command line handling for the "roads" subcommand
+    :return: args structure with parameters
+    """
+    parser = argparse.ArgumentParser(prog="fetchmap.py roads", description="manage the road index of shapefiles")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    build = commands.add_parser("build", help="build the road index of a shapefile, so maps are rendered without it")
+    build.add_argument("-S", "--shapefile", type=str, default=DEFAULT_SHAPEFILE, help="shapefile for streets")
+    return parser.parse_args(sys.argv[2:])
+
+
+def roads_command(args):
+    """
+    Run the "roads" subcommand
+    :param args: args structure from get_roads_cmdline_args()
+    :return: exit code
+    """
+    shapefile = get_path(args.shapefile)
+    if not os.path.exists(shapefile):
+        print("Shapefile {} not found".format(shapefile))
+        return 1
+    if not have_gdal():
+        print("The GDAL Python bindings are needed to read shapefiles")
+        return 1
+
+    filename = get_road_index_file(shapefile)
+    counts = build_road_index(shapefile, filename)
+    print("Road index {}:".format(filename))
+    for (minzoom, bucketzoom), count in zip(ROAD_INDEX_TIERS, counts):
+        print("    from zoom {:2}: {:8} roads".format(minzoom, count))
+    return 0
+
+
+def get_places_cmdline_args():
+    """
+    Command line handling for the "places" subcommand
+    :return: args structure with parameters
+    """
+    parser = argparse.ArgumentParser(prog="fetchmap.py places", description="manage the town names of the maps")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    importer = commands.add_parser("import", help="import the towns and cities of OpenStreetMap extracts")
+    importer.add_argument("extract", type=str, nargs="+",
+                          help="OSM XML file, optionally compressed (.osm.gz, .osm.bz2), or PBF file (.osm.pbf)")
+    return parser.parse_args(sys.argv[2:])
+
+
+def places_command(args):
+    """
+    Run the "places" subcommand
+    :param args: args structure from get_places_cmdline_args()
+    :return: exit code
+    """
+    result = 0
+    for extract in args.extract:
+        filename = get_path(extract)
+        if filename.endswith(".pbf") and not have_osmium():
+            print("{}: pyosmium is needed to read PBF files".format(extract))
+            result = 1
+            continue
+        try:
+            towns, cells = import_places(filename)
+        except (OSError, EOFError, ElementTree.ParseError) as e:
+            print("{}: {}".format(extract, e))
+            result = 1
+            continue
+        print("{}: {} towns imported, {} cells complete".format(extract, towns, cells))
+        if not cells:
+            print("    no bounds in the extract, the Overpass server is still queried for these areas")
+
+    if place_store:
+        place_store.close()
+    return result
+
+
+def is_tile_cache_dir(handle):
+    """
+    Check if a subdirectory of the cache directory is a directory tile cache, and not e.g. the GPX cache
+    :param handle: name of the subdirectory
+    :return: True for the directories of known tile sources, "user" and directories with zoom level subdirectories
+    """
+    if handle in TileserverList or handle == "user":
+        return True
+    path = os.path.join(Cachedir, handle)
+    return any(d.is_dir() and d.name.isdigit() for d in os.scandir(path))
+
+
+def get_cached_sources(handles=None):
+    """
+    Get the ids of the tile sources with an MBTiles cache file
+    :param handles: list of requested tile source ids, None for all
+    :return: list of tile source ids
+    """
+    if handles:
+        return [h for h in handles if os.path.exists(os.path.join(Cachedir, h + ".mbtiles"))]
+    if not os.path.isdir(Cachedir):
+        return []
+    return sorted(f.name[:-len(".mbtiles")] for f in os.scandir(Cachedir) if f.name.endswith(".mbtiles"))
+
+
+def print_cache_stats(handle, cache):
+    """
+    Print the statistics of a tile cache
+    :param handle: id of the tile source
+    :param cache: MBTilesCache instance
+    :return:
+    """
+    stats = cache.get_stats()
+    entries = sum(s[1] for s in stats)
+    size = sum(s[2] for s in stats)
+    hits = sum(s[3] for s in stats)
+    misses = sum(s[4] for s in stats)
+
+    print("{}: {} tiles, {}, hit ratio {}, {} known missing".format(
+        handle, entries, format_size(size), "{:.1%}".format(hits / (hits + misses)) if hits + misses else "n/a",
+        cache.get_missing_count()))
+    for zoom, entries, size, hits, misses in stats:
+        print("    zoom {:2}: {:8} tiles {:>12}  {:8} hits {:8} misses".format(zoom, entries, format_size(size),
+                                                                            hits, misses))
+
+
+def cache_command(args):
+    """
+    Run the "cache" subcommand
+    :param args: args structure from get_cache_cmdline_args()
+    :return:
+    """
+    if args.command == "migrate":
+        handles = args.tilesource
+        if not handles:
+            handles = sorted(d.name for d in os.scandir(Cachedir)
+                             if d.is_dir() and is_tile_cache_dir(d.name)) if os.path.isdir(Cachedir) else []
+
+        for handle in handles:
+            if not os.path.isdir(os.path.join(Cachedir, handle)):
+                print("No directory cache for tile source {}".format(handle))
+                continue
+            count = migrate_tile_cache(handle, args.delete)
+            print("{}: migrated {} tiles to {}.mbtiles".format(handle, count, handle))
+        return
+
+    if args.command == "prune" and not (args.zoom or args.older_than is not None or args.limit is not None or
+                                        args.missing):
+        print("Nothing to prune, use --zoom, --older-than, --limit or --missing")
+        return
+
+    handles = get_cached_sources(args.tilesource)
+    if not handles:
+        print("No tile cache found in {}".format(Cachedir))
+
+    for handle in handles:
+        cache = MBTilesCache(Cachedir, handle)
+        if args.command == "stats":
+            print_cache_stats(handle, cache)
+        elif args.command == "prune":
+            before = time.time() - args.older_than * 86400 if args.older_than is not None else None
+            count, size = 0, 0
+            if args.zoom or before is not None:
+                count, size = cache.prune(args.zoom, before)
+            if args.limit is not None:
+                evicted = cache.evict(args.limit)
+                count, size = count + evicted[0], size + evicted[1]
+            if count:
+                cache.vacuum()
+            if args.zoom or before is not None or args.limit is not None:
+                print("{}: removed {} tiles ({})".format(handle, count, format_size(size)))
+            if args.missing:
+                print("{}: forgot {} missing tiles".format(handle, cache.prune_missing(False)))
+        cache.close()
+
+
 if __name__ == "__main__":
     """
     Main logic 
@@ -1093,6 +4215,22 @@ if __name__ == "__main__":
     Programdir = get_programdir()
     Resourcedir = Programdir + os.path.sep + "resources"
 
+    if len(sys.argv) > 1 and sys.argv[1] == "cache":
+        cache_command(get_cache_cmdline_args())
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "places":
+        sys.exit(places_command(get_places_cmdline_args()))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "roads":
+        sys.exit(roads_command(get_roads_cmdline_args()))
+
+    if len(sys.argv) > 1 and sys.argv[1] == "seed":
+        args = get_seed_cmdline_args()
+        open_tilesource(args)
+        seed_cache(args)
+        sys.exit(0)
+
     args = get_cmdline_args()
     papersize = get_paper_size(args.papersize, False, args.dpi, args.margin)
     maxtilesx, maxtilesy = [papersize[0] / tilesize, papersize[1] / tilesize]
@@ -1101,14 +4239,8 @@ if __name__ == "__main__":
     landscape = args.landscape
     found = False
 
-    if args.tileserver:
-        tileshandle = "user"
-        tileserver = args.tileserver
-        style = "default"
-    else:
-        tileshandle = args.tilesource
-        tileserver = TileserverList[args.tilesource]["url"]
-        style = TileserverList[args.tilesource]["style"]
+    style = open_tilesource(args)
+    road_index = open_road_index(get_path(args.shapefile))
 
     if zoom < 0:
         for zoom in range(18, -1, -1):
@@ -1136,24 +4268,52 @@ if __name__ == "__main__":
     print("Size of paper: {}×{}".format(papersize[0], papersize[1]))
     print("Size of graphics: {}×{}".format(imagesize[0], imagesize[1]))
 
-    canvas = MapDraw(Image.new("RGBA", imagesize), args.north, args.west, zoom)
-    canvas.set_style(style)
-
-    stitch_map(canvas, swx, swy, nex, ney, zoom)
+    bandrows = numy
+    if args.band_height > 0:
+        bandrows = min(numy, math.ceil(args.band_height / tilesize))
+        print("Height of bands: {}".format(bandrows * tilesize))
 
-    if HAVE_GDAL:
-        draw_streets(canvas, swx, swy, nex, ney, zoom)
+    canvas = MapDraw(Image.new("RGB", (imagesize[0], bandrows * tilesize)), args.north, args.west, zoom,
+                     height=imagesize[1])
+    canvas.set_style(style)
+    canvas.tolerance = args.simplify
+    log_time("startup")
 
-    gpxlist = draw_gpx_tracks(canvas, args.gpx)
-    draw_town_labels(canvas, swx, swy, nex, ney, zoom)
-    draw_gpx_waypoints(gpxlist)
+    gpxlist = read_gpx_files(canvas, args.gpx)
+    add_gpx_obstacles(gpxlist)
+    log_time("gpx")
+    place_town_labels(canvas, swx, swy, nex, ney, zoom)
+    log_time("labels")
 
     if not args.dryrun:
-        canvas.image.convert("RGB").save(outfile)
+        writer = open_map_writer(outfile, imagesize, bandrows < numy)
+        render_map(canvas, gpxlist, swx, swy, nex, ney, zoom, bandrows, writer)
+        writer.close()
+        log_time("render")
 
         p = Path(outfile)
         htmlfile = str(p.parent) + os.path.sep + p.stem + ".html"
         with open(htmlfile, "w") as fp:
             fp.write(waypoints_as_html(gpxlist, outfile, imagesize))
     else:
+        render_map(canvas, gpxlist, swx, swy, nex, ney, zoom, bandrows)
+        log_time("render")
         print(waypoints_as_html(gpxlist, outfile, imagesize))
+
+    if args.simplify > 0 and canvas.vertices[0]:
+        print("Simplified lines: {} of {} points drawn ({:.1%})".format(canvas.vertices[1], canvas.vertices[0],
+                                                                        canvas.vertices[1] / canvas.vertices[0]))
+
+    print_missing_tiles()
+    tile_cache.close()
+    if road_index:
+        road_index.close()
+    if place_store:
+        place_store.close()
+    connection_pool.close()
+    if connection_pool.opened:
+        print("HTTP connections: {} opened, {} reused".format(connection_pool.opened, connection_pool.reused))
+
+    if args.timings:
+        log_time("finish")
+        print_timings()
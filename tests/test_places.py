@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import fetchmap
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "places.osm")
+
+
+class ImportPlacesTest(unittest.TestCase):
+    """
+    Import of the towns of an OSM extract into the place store
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        fetchmap.place_store = fetchmap.PlaceStore(os.path.join(self.tmpdir.name, "places.sqlite"))
+
+    def tearDown(self):
+        fetchmap.place_store.close()
+        fetchmap.place_store = None
+        self.tmpdir.cleanup()
+
+    def test_cells_inside(self):
+        # bounds 47.0, 8.0, 48.5, 11.5 cover cells 133-136 × 88-89 partially, two of them completely
+        self.assertEqual(fetchmap.get_cells_inside(47.0, 8.0, 48.5, 11.5, fetchmap.PLACE_CELL_ZOOM),
+                         (134, 89, 135, 89))
+        # inside cell 134/89, so no cell is covered completely
+        x1, y1, x2, y2 = fetchmap.get_cells_inside(47.1, 8.5, 47.9, 9.8, fetchmap.PLACE_CELL_ZOOM)
+        self.assertTrue(x1 > x2 or y2 > y1)
+
+    def test_import(self):
+        store = fetchmap.place_store
+        store.add_places([
+            {"id": 98, "name": "Outside", "class": "towns", "population": 0, "lat": 46.5, "lon": 7.5},
+            {"id": 99, "name": "Gone", "class": "towns", "population": 0, "lat": 47.5, "lon": 9.5},
+        ], [(46.0, 7.0, 49.0, 12.0)], [])
+
+        self.assertEqual(fetchmap.import_places(FIXTURE), (4, 2))
+
+        places = store.get_places(46.0, 7.0, 49.0, 12.0)
+        self.assertEqual([(p["name"], p["class"], p["population"]) for p in places], [
+            ("Zürich", "cities", 421878),
+            ("Winterthur", "towns", 0),
+            ("Vaduz", "capitals", 0),
+            ("Kempten", "towns", 68907),
+            ("Outside", "towns", 0),
+        ])
+        self.assertEqual(store.get_missing_cells(133, 89, 136, 88), [(133, 88), (134, 88), (135, 88), (136, 88),
+                                                                     (133, 89), (136, 89)])
+
+
+if __name__ == "__main__":
+    unittest.main()